@@ -12,11 +12,56 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
 app.config['SECRET_KEY'] = 'd20453a343424aafaa1ea9d7c7d190f5'
 app.config["REDIS_URL"] = "redis://127.0.0.1:6379/0"
 app.config["UP_DIR"] = os.path.join(os.path.abspath(os.path.dirname(__file__)), "static/uploads/")
+app.config["UPLOAD_TMP_DIR"] = os.path.join(os.path.abspath(os.path.dirname(__file__)), "tmp/uploads/")
+app.config["UPLOAD_MAX_SIZE"] = 20 * 1024 ** 3  # 分块上传的最大文件大小
+app.config["UPLOAD_CHUNK_MAX"] = 16 * 1024 ** 2  # 每块最大字节数
+app.config["UPLOAD_TTL"] = 24 * 3600  # 未完成的上传保留时间（秒）
 app.config["FC_DIR"] = os.path.join(os.path.abspath(os.path.dirname(__file__)), "static/uploads/users/")
+app.config["MEDIA_SENDFILE"] = None  # 视频发送方式，None由应用发送，nginx为X-Accel-Redirect，apache为X-Sendfile
+app.config["MEDIA_ACCEL_PREFIX"] = "/protected/uploads/"  # nginx中指向上传目录的internal地址
+app.config["MEDIA_MAX_AGE"] = 3600  # 视频的浏览器缓存时间（秒）
+app.config["MEDIA_BUFFER_SIZE"] = 64 * 1024  # 应用发送视频时每次读取的字节数
+app.config["CACHE_TIMEOUT"] = 60  # 缓存过期时间（秒）
+app.config["KEYSET_PAGINATION"] = False  # 列表默认使用游标分页
+app.config["KEYSET_PAGINATION_COUNT"] = False  # 游标分页时是否统计总数
+app.config["DANMAKU_MAX"] = 3000  # 每次请求最多返回的弹幕数
+app.config["DANMAKU_HOT_SIZE"] = 3000  # 每部电影保留在Redis中的弹幕数，超出的归档到MySQL
+app.config["DANMAKU_ARCHIVE_BATCH"] = 1000  # 每批归档的弹幕数
+app.config["DANMAKU_ARCHIVE_INTERVAL"] = 60  # 弹幕归档间隔（秒），0为不启动后台归档
+app.config["DANMAKU_STREAM_HEARTBEAT"] = 15  # 弹幕推送连接的心跳间隔（秒）
+app.config["DANMAKU_STREAM_BUFFER"] = 100  # 每个推送连接最多缓存的未发送弹幕
+app.config["PLAYNUM_FLUSH_INTERVAL"] = 10  # 播放量写回数据库的间隔（秒），0为不启动后台写回
+app.config["QUERY_BUDGET_STRICT"] = False  # 请求超出视图声明的SQL语句数时抛出异常，测试时开启
+app.config["INSTRUMENT"] = os.environ.get("INSTRUMENT") == "1"  # 统计每个请求的SQL、Redis、模板耗时并输出Server-Timing头
+app.config["SLOW_QUERY_THRESHOLD"] = 0.1  # 慢查询阈值（秒）
+app.config["SLOW_QUERY_LOG"] = None  # 慢查询日志文件，为空时写入标准日志
+app.config["METRICS_FLUSH_INTERVAL"] = 10  # 请求指标汇总到Redis的间隔（秒），0为不启动后台汇总
+app.config["METRICS_ALLOW"] = ["127.0.0.1"]  # 允许抓取/metrics的地址
+app.config["LOG_FLUSH_INTERVAL"] = 2  # 登录、操作日志批量写入数据库的间隔（秒），0为在请求中同步写入
+app.config["LOG_FLUSH_BATCH"] = 500  # 每批写入的日志条数
+app.config["LOG_RETENTION_DAYS"] = 90  # 登录、操作日志在主表中保留的天数
+app.config["LOG_ARCHIVE"] = True  # 过期日志移入归档表，False为直接删除
+app.config["LOG_PRUNE_CHUNK"] = 1000  # 每次移动或删除的日志条数
+app.config["LOG_RETENTION_INTERVAL"] = 300  # 登录日志汇总和过期日志清理的间隔（秒），0为不启动
+app.config["SEARCH_BACKEND"] = "index"  # 搜索方式，index为Redis倒排索引，sql为数据库LIKE查询（需支持窗口函数，MySQL 8+）
+app.config["SEARCH_CACHE_TIMEOUT"] = 60  # 搜索结果页缓存时间（秒）
+app.config["SUGGEST_SIZE"] = 10  # 搜索补全返回的标题数
+app.config["SUGGEST_CHECK_INTERVAL"] = 2  # 后台检查电影目录是否变化的间隔（秒），变化后重建搜索补全索引，0为不启动
+app.config["SUGGEST_REFRESH"] = 300  # 搜索补全按播放量重新排序的间隔（秒）
+app.config["UPLOAD_PURGE_INTERVAL"] = 3600  # 清理过期分块上传临时文件的间隔（秒），0为不启动
+app.config["STORAGE_GC_GRACE"] = 3600  # 新保存或刚复用的文件在这段时间（秒）内不会被回收
+app.config["STORAGE_RELEASE_GRACE"] = 60  # 记录不再引用文件时，这段时间（秒）内被其他请求保存或复用的文件留给定期回收
+app.config["STORAGE_GC_INTERVAL"] = 24 * 3600  # 回收没有引用的上传文件的间隔（秒），0为不启动
+app.config["IMAGE_QUALITY"] = 80  # 封面、头像缩略图的压缩质量
 app.debug = True  # 开启调试模式
 db = SQLAlchemy(app)
 rd = FlaskRedis(app)
 
+if app.config["INSTRUMENT"]:
+    from app import instrument
+
+    instrument.install()
+
 from app.admin import admin as admin_blueprint
 from app.home import home as home_blueprint
 
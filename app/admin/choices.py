@@ -0,0 +1,36 @@
+from app.cache import make_key, bump_version, get_json, set_json, get_local
+from app.models import Tag, Auth, Role
+
+
+def cached_choices(name, model):
+    """ 表单下拉选项，按数据版本号缓存在进程内和Redis中 """
+
+    def load(version):
+        key = make_key(name, "choices", version)
+        data = get_json(key)
+        if data is None:
+            data = [(v.id, v.name) for v in model.query.order_by(model.id).all()]
+            set_json(key, data)
+        return [tuple(v) for v in data]
+
+    return get_local(name, "choices", load)
+
+
+def tags():
+    """ 标签选项 """
+    return cached_choices("tag", Tag)
+
+
+def auths():
+    """ 权限选项 """
+    return cached_choices("auth", Auth)
+
+
+def roles():
+    """ 角色选项 """
+    return cached_choices("role", Role)
+
+
+def invalidate(name):
+    """ 标签、权限、角色变更后使选项缓存失效 """
+    bump_version(name)
@@ -1,10 +1,10 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, FileField, TextAreaField, SelectField, SelectMultipleField
+from wtforms import StringField, PasswordField, SubmitField, FileField, TextAreaField, SelectField, SelectMultipleField, \
+    HiddenField
 from wtforms.validators import DataRequired, ValidationError, EqualTo
 
-from app.models import Admin, Tag, Auth, Role
-
-tags = Tag.query.all()
+from app.admin import choices
+from app.models import Admin
 
 
 class LoginForm(FlaskForm):
@@ -88,6 +88,11 @@ class MovieForm(FlaskForm):
         ],
         description="文件",
     )
+    upload_id = HiddenField(
+        render_kw={
+            "id": "input_upload_id"
+        }
+    )
     info = TextAreaField(
         label="简介",
         validators=[
@@ -129,7 +134,6 @@ class MovieForm(FlaskForm):
             DataRequired('请选择标签！')
         ],
         coerce=int,
-        choices=[(tag.id, tag.name) for tag in tags],
         description="标签",
         render_kw={
             "class": "form-control",
@@ -179,6 +183,10 @@ class MovieForm(FlaskForm):
         }
     )
 
+    def __init__(self, *args, **kwargs):
+        super(MovieForm, self).__init__(*args, **kwargs)
+        self.tag_id.choices = choices.tags()
+
 
 class PreviewForm(FlaskForm):
     title = StringField(
@@ -297,7 +305,6 @@ class RoleForm(FlaskForm):
             DataRequired("请选择权限列表！")
         ],
         coerce=int,
-        choices=[(v.id, v.name) for v in Auth.query.all()],
         description="权限列表",
         render_kw={
             "class": "form-control",
@@ -310,6 +317,10 @@ class RoleForm(FlaskForm):
         }
     )
 
+    def __init__(self, *args, **kwargs):
+        super(RoleForm, self).__init__(*args, **kwargs)
+        self.auths.choices = choices.auths()
+
 
 class AdminForm(FlaskForm):
     name = StringField(
@@ -349,7 +360,6 @@ class AdminForm(FlaskForm):
     role_id = SelectField(
         label="所属角色",
         coerce=int,
-        choices=[(v.id, v.name) for v in Role.query.all()],
         render_kw={
             "class": "form-control",
         }
@@ -360,3 +370,7 @@ class AdminForm(FlaskForm):
             "class": "btn btn-primary",
         }
     )
+
+    def __init__(self, *args, **kwargs):
+        super(AdminForm, self).__init__(*args, **kwargs)
+        self.role_id.choices = choices.roles()
@@ -0,0 +1,64 @@
+from app.cache import make_key, bump_version, get_json, set_json, get_local
+from app.models import Admin, Auth, Role
+
+
+def load_auth_ids(version):
+    """ 从Redis或数据库加载 {路由: 权限编号} """
+    key = make_key("auth", "urls", version)
+    data = get_json(key)
+    if data is None:
+        data = {v.url: v.id for v in Auth.query.all()}
+        set_json(key, data)
+    return data
+
+
+def load_role_mask(role_id, version):
+    """ 从Redis或数据库加载角色的权限位图，角色不存在时返回None """
+    key = make_key("auth", "role", version, role_id)
+    data = get_json(key)
+    if data is None:
+        role = Role.query.get(role_id)
+        data = dict(mask=None if role is None else role.auth_mask)
+        set_json(key, data)
+    return data["mask"]
+
+
+def load_admin_role(admin_id, version):
+    """ 从Redis或数据库加载管理员的角色，管理员不存在时exists为False """
+    key = make_key("auth", "admin", version, admin_id)
+    data = get_json(key)
+    if data is None:
+        admin = Admin.query.get(admin_id)
+        data = dict(exists=admin is not None, role_id=None if admin is None else admin.role_id)
+        set_json(key, data)
+    return data
+
+
+def admin_role(admin_id):
+    """ 管理员的角色，返回(管理员是否存在, 角色编号)，随权限版本号失效 """
+    data = get_local("auth", ("admin", admin_id), lambda version: load_admin_role(admin_id, version))
+    return data["exists"], data["role_id"]
+
+
+def auth_ids():
+    """ 路由对应的权限编号 """
+    return get_local("auth", "urls", load_auth_ids)
+
+
+def role_mask(role_id):
+    """ 角色的权限位图，编译一次后缓存在进程内和Redis中 """
+    return get_local("auth", role_id, lambda version: load_role_mask(role_id, version))
+
+
+def allowed(role_id, rule):
+    """ 角色是否可以访问路由，角色不存在时不做限制 """
+    mask = role_mask(role_id)
+    if mask is None:
+        return True
+    auth_id = auth_ids().get(rule)
+    return auth_id is not None and mask >> auth_id & 1 == 1
+
+
+def invalidate():
+    """ 管理员、角色或权限变更后使缓存的权限失效 """
+    bump_version("auth")
@@ -0,0 +1,148 @@
+import os
+import re
+import time
+import uuid
+import zlib
+
+from app import app, rd, storage
+from app.cache import make_key
+
+
+def session_key(upload_id):
+    """ 上传会话：哈希，记录文件名、总大小、已写入的偏移、CRC32和所属管理员 """
+    return make_key("upload", upload_id)
+
+
+def lock_key(upload_id):
+    return make_key("upload", upload_id, "lock")
+
+
+def part_path(upload_id):
+    """ 上传中的临时文件，不放在静态目录下 """
+    return os.path.join(app.config["UPLOAD_TMP_DIR"], "%s.part" % upload_id)
+
+
+class UploadError(Exception):
+    """ 上传请求不合法，status为返回的HTTP状态码 """
+
+    def __init__(self, message, status=400, offset=None):
+        super(UploadError, self).__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def create(admin_id, filename, size):
+    """ 新建上传会话，返回会话信息 """
+    if size < 0 or size > app.config["UPLOAD_MAX_SIZE"]:
+        raise UploadError("文件大小不合法")
+    if not os.path.exists(app.config["UPLOAD_TMP_DIR"]):
+        os.makedirs(app.config["UPLOAD_TMP_DIR"])
+    upload_id = uuid.uuid4().hex
+    open(part_path(upload_id), "wb").close()
+    info = dict(filename=filename, size=size, offset=0, crc=0, admin_id=admin_id, done=0)
+    pipe = rd.pipeline()
+    pipe.hmset(session_key(upload_id), info)
+    pipe.expire(session_key(upload_id), app.config["UPLOAD_TTL"])
+    pipe.execute()
+    info["id"] = upload_id
+    return info
+
+
+def get(upload_id, admin_id):
+    """ 读取上传会话，不存在或不属于该管理员时抛出404 """
+    if not re.match(r"^[0-9a-f]{32}$", upload_id or ""):
+        raise UploadError("上传不存在或已过期", 404)
+    data = rd.hgetall(session_key(upload_id))
+    if not data or int(data[b"admin_id"]) != admin_id:
+        raise UploadError("上传不存在或已过期", 404)
+    return dict(
+        id=upload_id,
+        filename=data[b"filename"].decode("utf-8"),
+        size=int(data[b"size"]),
+        offset=int(data[b"offset"]),
+        crc=int(data[b"crc"]),
+        admin_id=admin_id,
+        done=int(data[b"done"]),
+    )
+
+
+def write_chunk(upload_id, admin_id, offset, stream, length, chunk_crc=None):
+    """ 把请求体按块写入临时文件，offset必须等于已写入的大小，返回更新后的会话信息 """
+    if not rd.set(lock_key(upload_id), 1, nx=True, ex=600):
+        raise UploadError("该文件正在上传", 409)
+    try:
+        info = get(upload_id, admin_id)
+        if info["done"]:
+            raise UploadError("上传已完成", 409, info["offset"])
+        if offset != info["offset"]:
+            raise UploadError("偏移不一致", 409, info["offset"])
+        if length is None or length > app.config["UPLOAD_CHUNK_MAX"] or offset + length > info["size"]:
+            raise UploadError("分块大小不合法", 400, info["offset"])
+
+        crc = info["crc"]
+        received = 0
+        part_crc = 0
+        buffer_size = app.config["MEDIA_BUFFER_SIZE"]
+        with open(part_path(upload_id), "r+b") as f:
+            f.seek(offset)
+            while received < length:
+                data = stream.read(min(buffer_size, length - received))
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+                crc = zlib.crc32(data, crc)
+                part_crc = zlib.crc32(data, part_crc)
+            # 客户端断开或校验失败时丢弃这一块，下次从原偏移重传
+            if received != length or (chunk_crc is not None and part_crc & 0xffffffff != chunk_crc):
+                f.truncate(offset)
+                raise UploadError("分块不完整或校验失败", 400, offset)
+            f.truncate(offset + length)
+
+        info["offset"] = offset + length
+        info["crc"] = crc & 0xffffffff
+        pipe = rd.pipeline()
+        pipe.hmset(session_key(upload_id), dict(offset=info["offset"], crc=info["crc"]))
+        pipe.expire(session_key(upload_id), app.config["UPLOAD_TTL"])
+        pipe.execute()
+        return info
+    finally:
+        rd.delete(lock_key(upload_id))
+
+
+def finish(upload_id, admin_id, crc=None):
+    """ 确认上传完成，可以校验整个文件的CRC32 """
+    info = get(upload_id, admin_id)
+    if info["offset"] != info["size"]:
+        raise UploadError("文件尚未上传完", 409, info["offset"])
+    if crc is not None and crc != info["crc"]:
+        raise UploadError("文件校验失败", 400, info["offset"])
+    rd.hset(session_key(upload_id), "done", 1)
+    info["done"] = 1
+    return info
+
+
+def attach(upload_id, admin_id):
+    """ 把已完成的上传移入存储并删除上传会话，返回存储的文件名 """
+    info = get(upload_id, admin_id)
+    if not info["done"]:
+        raise UploadError("上传尚未完成", 409, info["offset"])
+    if not rd.delete(session_key(upload_id)):  # 同一上传只能使用一次
+        raise UploadError("上传不存在或已过期", 404)
+    return storage.store(part_path(upload_id), info["filename"])
+
+
+def purge():
+    """ 删除会话已过期的临时文件，由后台任务定期调用 """
+    directory = app.config["UPLOAD_TMP_DIR"]
+    if not os.path.exists(directory):
+        return 0
+    removed = 0
+    expire = time.time() - app.config["UPLOAD_TTL"]
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        upload_id = name.split(".")[0]
+        if os.path.getmtime(path) < expire and not rd.exists(session_key(upload_id)):
+            os.remove(path)
+            removed += 1
+    return removed
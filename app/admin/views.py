@@ -1,15 +1,16 @@
 import datetime
-import os
-import uuid
 from functools import wraps
 
-from flask import render_template, redirect, url_for, flash, session, request, abort
+from flask import render_template, redirect, url_for, flash, session, request, abort, jsonify
+from sqlalchemy.orm import contains_eager
 from werkzeug.security import generate_password_hash
-from werkzeug.utils import secure_filename
 
-from app import db, app
+from app import db, catalog, counter, danmaku, metrics, logqueue, storage, images
+from app.admin import permission, choices, upload
 from app.admin.forms import LoginForm, TagForm, MovieForm, PreviewForm, PwdForm, AuthForm, RoleForm, AdminForm
-from app.models import Admin, Tag, Movie, Preview, User, Comment, Moviecol, Oplog, Adminlog, Userlog, Auth, Role
+from app.models import Admin, Tag, Movie, Preview, User, Comment, Moviecol, Oplog, Auth, Role, LoginlogDaily
+from app.pagination import paginate
+from app.querybudget import query_budget
 from . import admin
 
 
@@ -32,31 +33,40 @@ def tpl_extra():
     return data
 
 
-# 修改文件名称
-def change_filename(filename):
-    fileinfo = os.path.splitext(filename)
-    filename = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + str(uuid.uuid4().hex) + fileinfo[-1]
-    return filename
+# 保存电影表单中的视频，分块上传的移入存储，返回文件名
+def save_movie_file(form):
+    if form.upload_id.data:
+        return upload.attach(form.upload_id.data, session["admin_id"])
+    return storage.save(form.url.data)
+
+
+# 登录日志汇总中会员或管理员的名称
+def subject_names(model, items):
+    ids = set(v.subject_id for v in items)
+    if not ids:
+        return {}
+    return {v.id: v.name for v in model.query.filter(model.id.in_(ids))}
+
+
+# 从session中删除管理员的信息
+def clear_session():
+    session.pop('admin', None)
+    session.pop('admin_id', None)
+    session.pop('admin_role_id', None)  # 旧版本登录时记录的角色
 
 
 # 访问权限控制装饰器
 def permission_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        admin = Admin.query.join(
-            Role
-        ).filter(
-            Role.id == Admin.role_id,
-            Admin.id == session["admin_id"]
-        ).first()
-        if admin is None:
+        exists, role_id = permission.admin_role(session["admin_id"])
+        if not exists:  # 管理员已被删除，清除会话重新登录
+            clear_session()
+            return redirect(url_for('admin.login'))
+        if role_id is None:
             return f(*args, **kwargs)
-        auths = admin.role.auths
-        auths = list(map(lambda v: int(v), auths.split(",")))
-        auth_list = Auth.query.all()
-        urls = [v.url for v in auth_list for val in auths if val == v.id]
         rule = request.url_rule
-        if str(rule) not in urls:
+        if not permission.allowed(role_id, str(rule)):
             abort(404)
         return f(*args, **kwargs)
 
@@ -70,6 +80,14 @@ def index():
     return render_template('admin/index.html')
 
 
+@admin.route('/metrics/', methods=['GET'])
+@admin_login_req
+@permission_required
+def metrics_data():
+    """ 运行指标，供控制面板轮询 """
+    return jsonify(metrics.collect())
+
+
 @admin.route('/login/', methods=['GET', 'POST'])
 def login():
     """ 登录 """
@@ -83,14 +101,12 @@ def login():
         # session中写入用户信息
         session['admin'] = data['account']
         session['admin_id'] = account.id
-        # 添加用户登录日志
-        account_log = Adminlog(
+        # 添加用户登录日志，由后台任务批量写入数据库
+        logqueue.enqueue(
+            "adminlog",
             admin_id=account.id,
             ip=request.remote_addr,
         )
-        # 写入到数据库中
-        db.session.add(account_log)
-        db.session.commit()
         return redirect(request.args.get('next') or url_for('admin.index'))
     return render_template("admin/login.html", form=form)
 
@@ -99,9 +115,7 @@ def login():
 @admin_login_req
 def logout():
     """ 退出 """
-    # 从session中删除用户的信息
-    session.pop('admin', None)
-    session.pop('admin_id', None)
+    clear_session()
     return redirect(url_for('admin.login'))
 
 
@@ -136,15 +150,16 @@ def tag_add():
         # 创建新标签
         tag = Tag(name=data['name'])
         db.session.add(tag)
+        db.session.commit()
         flash('添加标签成功!', 'ok')
         # 添加一条操作日志
-        op_log = Oplog(
+        logqueue.enqueue(
+            "oplog",
             admin_id=session['admin_id'],
             ip=request.remote_addr,
             reason="添加标签%s" % data['name']
         )
-        db.session.add(op_log)
-        db.session.commit()
+        catalog.tag_saved(tag)
         return redirect(url_for('admin.tag_add'))
     return render_template('admin/tag_add.html', form=form)
 
@@ -166,6 +181,7 @@ def tag_edit(id=None):
         tag.name = data['name']
         db.session.add(tag)
         db.session.commit()
+        catalog.tag_saved(tag)
         flash('修改标签成功!', 'ok')
         return redirect(url_for('admin.tag_edit', id=id))
     return render_template('admin/tag_edit.html', form=form, tag=tag)
@@ -176,7 +192,7 @@ def tag_edit(id=None):
 @permission_required
 def tag_list(page):
     """ 标签列表 """
-    page_data = Tag.query.order_by(Tag.addtime.desc()).paginate(page=page, per_page=10)
+    page_data = paginate(Tag.query, [Tag.addtime.desc(), Tag.id.desc()], page, 10)
     return render_template('admin/tag_list.html', page_data=page_data)
 
 
@@ -188,6 +204,7 @@ def tag_del(id):
     tag = Tag.query.filter_by(id=id).first_or_404()  # 获取要删除的标签
     db.session.delete(tag)  # 进行删除
     db.session.commit()
+    catalog.tag_deleted(tag)
     flash("删除标签成功！", 'ok')
     return redirect(url_for('admin.tag_list', page=1))
 
@@ -198,16 +215,17 @@ def tag_del(id):
 def movie_add():
     """ 添加电影 """
     form = MovieForm()
+    if form.upload_id.data:  # 视频已经分块上传完成
+        form.url.validators = []
     if form.validate_on_submit():
         data = form.data
-        file_url = secure_filename(form.url.data.filename)
-        file_logo = secure_filename(form.logo.data.filename)
-        if not os.path.exists(app.config["UP_DIR"]):  # 如果目录不存在则创建目录
-            os.makedirs(app.config["UP_DIR"])
-        url = change_filename(file_url)  # 生成视频保存路径
-        logo = change_filename(file_logo)  # 生成图片保存路径
-        form.url.data.save(app.config["UP_DIR"] + url)  # 保存视频
-        form.logo.data.save(app.config["UP_DIR"] + logo)  # 保存图片
+        try:
+            url = save_movie_file(form)  # 保存视频
+        except upload.UploadError as e:
+            flash(str(e), "err")
+            return redirect(url_for('admin.movie_add'))
+        logo = storage.save(form.logo.data)  # 保存图片
+        images.generate(logo, "cover")  # 生成各尺寸的缩略图
         # 创建电影并保存到数据库中
         movie = Movie(
             title=data["title"],
@@ -222,22 +240,75 @@ def movie_add():
         )
         db.session.add(movie)
         db.session.commit()
+        catalog.movie_saved(movie)
         flash("添加电影成功！", "ok")
         return redirect(url_for('admin.movie_add'))
     return render_template("admin/movie_add.html", form=form)
 
 
+@admin.errorhandler(upload.UploadError)
+def upload_error(e):
+    return jsonify(error=str(e), offset=e.offset), e.status
+
+
+def upload_info(info):
+    return jsonify(id=info["id"], offset=info["offset"], size=info["size"], crc=info["crc"], done=info["done"])
+
+
+@admin.route('/upload/', methods=['POST'])
+@admin_login_req
+@permission_required
+def upload_create():
+    """ 新建分块上传，请求体为JSON：{"filename": 文件名, "size": 字节数} """
+    data = request.get_json(silent=True) or {}
+    size = data.get("size")
+    if not data.get("filename") or not isinstance(size, int):
+        raise upload.UploadError("缺少文件名或大小")
+    info = upload.create(session["admin_id"], data["filename"], size)
+    return upload_info(info), 201
+
+
+@admin.route('/upload/<upload_id>/', methods=['GET', 'PUT'])
+@admin_login_req
+@permission_required
+def upload_chunk(upload_id):
+    """ GET查询已上传的偏移以便续传；PUT ?offset=N 写入一块，请求体为原始字节 """
+    if request.method == 'GET':
+        info = upload.get(upload_id, session["admin_id"])
+    else:
+        offset = request.args.get("offset", type=int)
+        chunk_crc = request.headers.get("X-Chunk-Crc32", type=int)
+        info = upload.write_chunk(
+            upload_id, session["admin_id"], offset, request.stream, request.content_length, chunk_crc
+        )
+    return upload_info(info)
+
+
+@admin.route('/upload/<upload_id>/finish/', methods=['POST'])
+@admin_login_req
+@permission_required
+def upload_finish(upload_id):
+    """ 确认上传完成，请求体可带整个文件的CRC32：{"crc": 校验值} """
+    data = request.get_json(silent=True) or {}
+    crc = data.get("crc")
+    info = upload.finish(upload_id, session["admin_id"], crc if isinstance(crc, int) else None)
+    return upload_info(info)
+
+
 @admin.route('/movie/list/<int:page>/')
 @admin_login_req
 @permission_required
+@query_budget(5)
 def movie_list(page=1):
     """ 电影列表 """
-    page_data = Movie.query.join(Tag).filter(
+    query = Movie.query.join(Tag).filter(
         Tag.id == Movie.tag_id
-    ).order_by(
-        Movie.addtime.desc()
-    ).paginate(page=page, per_page=10)
-    return render_template('admin/movie_list.html', page_data=page_data)
+    ).options(
+        contains_eager(Movie.tag)
+    )
+    page_data = paginate(query, [Movie.addtime.desc(), Movie.id.desc()], page, 10)
+    pending = counter.pending_many([v.id for v in page_data.items])  # 尚未写回的播放量
+    return render_template('admin/movie_list.html', page_data=page_data, pending=pending)
 
 
 @admin.route('/movie/del/<int:id>/', methods=['GET'])
@@ -245,9 +316,12 @@ def movie_list(page=1):
 @permission_required
 def movie_del(id):
     """ 删除电影 """
-    tag = Movie.query.filter_by(id=id).first_or_404()  # 获取要删除的电影
-    db.session.delete(tag)  # 删除
+    movie = Movie.query.filter_by(id=id).first_or_404()  # 获取要删除的电影
+    danmaku.remove(movie.id)  # 删除弹幕，归档的弹幕有外键约束
+    db.session.delete(movie)  # 删除
     db.session.commit()
+    catalog.movie_deleted(movie)
+    storage.release("UP_DIR", movie.url, movie.logo)
     flash("删除电影成功！", 'ok')
     return redirect(url_for('admin.movie_list', page=1))
 
@@ -274,19 +348,19 @@ def movie_edit(id):
             flash("片名已经存在！", "err")
             return redirect(url_for('admin.movie_edit', id=id))
 
-        if not os.path.exists(app.config["UP_DIR"]):  # 如果保存资源的目录不存在，创建目录
-            os.makedirs(app.config["UP_DIR"])
-
-        if form.url.data.filename != "":  # 传递的视频不为空
-            file_url = secure_filename(form.url.data.filename)
-            movie.url = change_filename(file_url)
-            form.url.data.save(app.config["UP_DIR"] + movie.url)
+        old_files = (movie.url, movie.logo)
+        if form.upload_id.data or form.url.data.filename != "":  # 传递的视频不为空
+            try:
+                movie.url = save_movie_file(form)
+            except upload.UploadError as e:
+                flash(str(e), "err")
+                return redirect(url_for('admin.movie_edit', id=id))
 
         if form.logo.data.filename != "":  # 传递的图片不为空
-            file_logo = secure_filename(form.logo.data.filename)
-            movie.logo = change_filename(file_logo)
-            form.logo.data.save(app.config["UP_DIR"] + movie.logo)
+            movie.logo = storage.save(form.logo.data)
+            images.generate(movie.logo, "cover")
 
+        old_tag_id = movie.tag_id
         # 进行相对于的赋值
         movie.star = data["star"]
         movie.tag_id = data["tag_id"]
@@ -297,6 +371,8 @@ def movie_edit(id):
         movie.release_time = data["release_time"]
         db.session.add(movie)
         db.session.commit()
+        catalog.movie_saved(movie, old_tag_id)
+        storage.release("UP_DIR", *old_files)  # 被替换的文件没有其他引用时删除
         flash("修改电影成功！", "ok")
         return redirect(url_for('admin.movie_edit', id=movie.id))
     return render_template("admin/movie_edit.html", form=form, movie=movie)
@@ -310,11 +386,8 @@ def preview_add():
     form = PreviewForm()
     if form.validate_on_submit():
         data = form.data
-        file_logo = secure_filename(form.logo.data.filename)
-        if not os.path.exists(app.config["UP_DIR"]):
-            os.makedirs(app.config["UP_DIR"])
-        logo = change_filename(file_logo)
-        form.logo.data.save(app.config["UP_DIR"] + logo)
+        logo = storage.save(form.logo.data)
+        images.generate(logo, "cover")
         preview = Preview(
             title=data["title"],
             logo=logo
@@ -331,9 +404,7 @@ def preview_add():
 @permission_required
 def preview_list(page=1):
     """ 预告列表 """
-    page_data = Preview.query.order_by(
-        Preview.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    page_data = paginate(Preview.query, [Preview.addtime.desc(), Preview.id.desc()], page, 10)
     return render_template('admin/preview_list.html', page_data=page_data)
 
 
@@ -345,6 +416,7 @@ def preview_del(id):
     preview = Preview.query.get_or_404(id)  # 获取要删除的预告
     db.session.delete(preview)  # 删除
     db.session.commit()
+    storage.release("UP_DIR", preview.logo)
     flash("删除预告成功！", "ok")
     return redirect(url_for('admin.preview_list', page=1))
 
@@ -362,14 +434,15 @@ def preview_edit(id):
 
     if form.validate_on_submit():
         data = form.data
+        old_logo = preview.logo
         if form.logo.data.filename != "":  # 如果上传了封面
-            file_logo = secure_filename(form.logo.data.filename)
-            preview.logo = change_filename(file_logo)
-            form.logo.data.save(app.config["UP_DIR"] + preview.logo)
+            preview.logo = storage.save(form.logo.data)
+            images.generate(preview.logo, "cover")
         # 修改预告信息
         preview.title = data["title"]
         db.session.add(preview)
         db.session.commit()
+        storage.release("UP_DIR", old_logo)
         flash("修改预告成功！", "ok")
         return redirect(url_for('admin.preview_edit', id=id))
     return render_template("admin/preview_edit.html", form=form, preview=preview)
@@ -380,9 +453,7 @@ def preview_edit(id):
 @permission_required
 def user_list(page=1):
     """ 会员列表 """
-    page_data = User.query.order_by(
-        User.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    page_data = paginate(User.query, [User.addtime.desc(), User.id.desc()], page, 10)
     return render_template("admin/user_list.html", page_data=page_data)
 
 
@@ -403,6 +474,7 @@ def user_del(id=None):
     user = User.query.get_or_404(int(id))
     db.session.delete(user)
     db.session.commit()
+    storage.release("FC_DIR", user.face)
     flash("删除会员成功！", "ok")
     return redirect(url_for('admin.user_list', page=1))
 
@@ -410,18 +482,21 @@ def user_del(id=None):
 @admin.route("/comment/list/<int:page>/", methods=["GET"])
 @admin_login_req
 @permission_required
+@query_budget(5)
 def comment_list(page=1):
     """ 评论列表 """
-    page_data = Comment.query.join(
+    query = Comment.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == Comment.movie_id,
         User.id == Comment.user_id
-    ).order_by(
-        Comment.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Comment.movie),
+        contains_eager(Comment.user)
+    )
+    page_data = paginate(query, [Comment.addtime.desc(), Comment.id.desc()], page, 10)
     return render_template("admin/comment_list.html", page_data=page_data)
 
 
@@ -440,20 +515,23 @@ def comment_del(id):
 @admin.route("/moviecol/list/<int:page>/", methods=["GET"])
 @admin_login_req
 @permission_required
+@query_budget(5)
 def moviecol_list(page=None):
     """ 收藏列表 """
     if page is None:
         page = 1
-    page_data = Moviecol.query.join(
+    query = Moviecol.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == Moviecol.movie_id,
         User.id == Moviecol.user_id
-    ).order_by(
-        Moviecol.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Moviecol.movie),
+        contains_eager(Moviecol.user)
+    )
+    page_data = paginate(query, [Moviecol.addtime.desc(), Moviecol.id.desc()], page, 10)
     return render_template("admin/moviecol_list.html", page_data=page_data)
 
 
@@ -472,46 +550,42 @@ def moviecol_del(id):
 @admin.route("/oplog/list/<int:page>/", methods=["GET"])
 @admin_login_req
 @permission_required
+@query_budget(5)
 def oplog_list(page=1):
     """ 操作日志 """
-    page_data = Oplog.query.join(
+    query = Oplog.query.join(
         Admin
     ).filter(
         Admin.id == Oplog.admin_id,
-    ).order_by(
-        Oplog.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Oplog.admin)
+    )
+    page_data = paginate(query, [Oplog.addtime.desc(), Oplog.id.desc()], page, 10)
     return render_template("admin/oplog_list.html", page_data=page_data)
 
 
 @admin.route("/adminloginlog/list/<int:page>/", methods=["GET"])
 @admin_login_req
 @permission_required
+@query_budget(5)
 def adminloginlog_list(page=1):
-    """ 管理员登录日志 """
-    page_data = Adminlog.query.join(
-        Admin
-    ).filter(
-        Admin.id == Adminlog.admin_id,
-    ).order_by(
-        Adminlog.addtime.desc()
-    ).paginate(page=page, per_page=10)
-    return render_template("admin/adminloginlog_list.html", page_data=page_data)
+    """ 管理员登录日志，按天汇总 """
+    query = LoginlogDaily.query.filter_by(kind="admin")
+    page_data = paginate(query, [LoginlogDaily.day.desc(), LoginlogDaily.id.desc()], page, 10)
+    names = subject_names(Admin, page_data.items)
+    return render_template("admin/adminloginlog_list.html", page_data=page_data, names=names)
 
 
 @admin.route("/userloginlog/list/<int:page>/", methods=["GET"])
 @admin_login_req
 @permission_required
+@query_budget(5)
 def userloginlog_list(page=1):
-    """ 会员登录日志 """
-    page_data = Userlog.query.join(
-        User
-    ).filter(
-        User.id == Userlog.user_id,
-    ).order_by(
-        Userlog.addtime.desc()
-    ).paginate(page=page, per_page=10)
-    return render_template("admin/userloginlog_list.html", page_data=page_data)
+    """ 会员登录日志，按天汇总 """
+    query = LoginlogDaily.query.filter_by(kind="user")
+    page_data = paginate(query, [LoginlogDaily.day.desc(), LoginlogDaily.id.desc()], page, 10)
+    names = subject_names(User, page_data.items)
+    return render_template("admin/userloginlog_list.html", page_data=page_data, names=names)
 
 
 @admin.route("/role/add/", methods=["GET", "POST"])
@@ -524,10 +598,11 @@ def role_add():
         data = form.data
         role = Role(
             name=data["name"],
-            auths=",".join(map(lambda v: str(v), data["auths"]))  # 传过来的数组转换为以，拼接的自促
+            auths=Auth.query.filter(Auth.id.in_(data["auths"])).all()
         )
         db.session.add(role)
         db.session.commit()
+        choices.invalidate("role")
         flash("添加角色成功！", "ok")
     return render_template("admin/role_add.html", form=form)
 
@@ -537,9 +612,7 @@ def role_add():
 @permission_required
 def role_list(page=1):
     """ 角色列表 """
-    page_data = Role.query.order_by(
-        Role.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    page_data = paginate(Role.query, [Role.addtime.desc(), Role.id.desc()], page, 10)
     return render_template("admin/role_list.html", page_data=page_data)
 
 
@@ -551,6 +624,8 @@ def role_del(id=None):
     role = Role.query.filter_by(id=id).first_or_404()
     db.session.delete(role)
     db.session.commit()
+    permission.invalidate()
+    choices.invalidate("role")
     flash("删除角色成功！", "ok")
     return redirect(url_for('admin.role_list', page=1))
 
@@ -563,14 +638,15 @@ def role_edit(id):
     form = RoleForm()
     role = Role.query.get_or_404(id)
     if request.method == "GET":
-        auths = role.auths
-        form.auths.data = list(map(lambda v: int(v), auths.split(",")))
+        form.auths.data = [v.id for v in role.auths]
     if form.validate_on_submit():
         data = form.data
         role.name = data["name"]
-        role.auths = ",".join(map(lambda v: str(v), data["auths"]))
+        role.auths = Auth.query.filter(Auth.id.in_(data["auths"])).all()
         db.session.add(role)
         db.session.commit()
+        permission.invalidate()
+        choices.invalidate("role")
         flash("修改角色成功！", "ok")
     return render_template("admin/role_edit.html", form=form, role=role)
 
@@ -589,6 +665,7 @@ def auth_add():
         )
         db.session.add(auth)
         db.session.commit()
+        permission.invalidate()
         flash("添加权限成功！", "ok")
     return render_template("admin/auth_add.html", form=form)
 
@@ -598,9 +675,7 @@ def auth_add():
 @permission_required
 def auth_list(page=1):
     """ 权限列表 """
-    page_data = Auth.query.order_by(
-        Auth.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    page_data = paginate(Auth.query, [Auth.addtime.desc(), Auth.id.desc()], page, 10)
     return render_template("admin/auth_list.html", page_data=page_data)
 
 
@@ -612,6 +687,7 @@ def auth_del(id=None):
     auth = Auth.query.filter_by(id=id).first_or_404()
     db.session.delete(auth)
     db.session.commit()
+    permission.invalidate()
     flash("删除标签成功！", "ok")
     return redirect(url_for('admin.auth_list', page=1))
 
@@ -629,6 +705,7 @@ def auth_edit(id=None):
         auth.name = data["name"]
         db.session.add(auth)
         db.session.commit()
+        permission.invalidate()
         flash("修改权限成功！", "ok")
         redirect(url_for('admin.auth_edit', id=id))
     return render_template("admin/auth_edit.html", form=form, auth=auth)
@@ -650,6 +727,7 @@ def admin_add():
         )
         db.session.add(admin)
         db.session.commit()
+        permission.invalidate()
         flash("添加管理员成功！", "ok")
     return render_template("admin/admin_add.html", form=form)
 
@@ -657,13 +735,15 @@ def admin_add():
 @admin.route("/admin/list/<int:page>/", methods=["GET"])
 @admin_login_req
 @permission_required
+@query_budget(5)
 def admin_list(page=1):
     """ 管理员列表 """
-    page_data = Admin.query.join(
+    query = Admin.query.join(
         Role
     ).filter(
         Role.id == Admin.role_id
-    ).order_by(
-        Admin.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Admin.role)
+    )
+    page_data = paginate(query, [Admin.addtime.desc(), Admin.id.desc()], page, 10)
     return render_template("admin/admin_list.html", page_data=page_data)
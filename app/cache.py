@@ -0,0 +1,46 @@
+import json
+
+from app import app, rd
+
+# 进程内缓存，{(数据名, 键): (版本号, 值)}
+local_cache = {}
+
+
+def make_key(*parts):
+    """ 拼接缓存键 """
+    return ":".join(str(v) for v in parts)
+
+
+def get_version(name):
+    """ 获取数据版本号 """
+    version = rd.get(make_key("version", name))
+    return int(version) if version else 0
+
+
+def bump_version(name):
+    """ 递增数据版本号，旧版本号下的缓存不再被读取 """
+    return rd.incr(make_key("version", name))
+
+
+def get_json(key):
+    """ 读取JSON缓存，未命中返回None """
+    value = rd.get(key)
+    if value is None:
+        return None
+    return json.loads(value.decode("utf-8"))
+
+
+def set_json(key, value, timeout=None):
+    """ 写入JSON缓存 """
+    rd.set(key, json.dumps(value), ex=timeout or app.config["CACHE_TIMEOUT"])
+
+
+def get_local(name, key, loader):
+    """ 进程内缓存，数据版本号变化后调用loader(version)重新加载 """
+    version = get_version(name)
+    hit = local_cache.get((name, key))
+    if hit is not None and hit[0] == version:
+        return hit[1]
+    value = loader(version)
+    local_cache[(name, key)] = (version, value)
+    return value
@@ -0,0 +1,29 @@
+from app import ranking, search
+from app.cache import bump_version
+
+
+def movie_saved(movie, old_tag_id=None):
+    """ 电影新增或修改后通知缓存、排行和搜索索引 """
+    bump_version("catalog")
+    ranking.add(movie, old_tag_id)
+    search.index_movie(movie)
+
+
+def movie_deleted(movie):
+    """ 电影删除后通知缓存、排行和搜索索引 """
+    bump_version("catalog")
+    ranking.remove(movie)
+    search.remove_movie(movie.id)
+
+
+def tag_saved(tag):
+    """ 标签新增或修改后通知缓存 """
+    bump_version("catalog")
+    bump_version("tag")
+
+
+def tag_deleted(tag):
+    """ 标签删除后通知缓存和排行 """
+    bump_version("catalog")
+    bump_version("tag")
+    ranking.remove_tag(tag.id)
@@ -0,0 +1,34 @@
+import hashlib
+from functools import wraps
+
+from flask import request, make_response, Response
+
+from app.cache import get_version
+
+
+def conditional(version_name):
+    """ 条件GET装饰器：ETag由version_name(*args, **kwargs)对应的数据版本号和查询参数生成，
+        客户端If-None-Match命中时直接返回304，不执行视图；数据变更时调用cache.bump_version使其失效 """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return f(*args, **kwargs)
+            name = version_name(*args, **kwargs)
+            etag = "%s-%s-%s" % (
+                name,
+                get_version(name),
+                hashlib.md5(request.query_string).hexdigest()[:8]
+            )
+            if request.if_none_match.contains(etag):
+                resp = Response(status=304)
+            else:
+                resp = make_response(f(*args, **kwargs))
+            resp.set_etag(etag)
+            resp.headers["Cache-Control"] = "no-cache"
+            return resp
+
+        return decorated_function
+
+    return decorator
@@ -0,0 +1,83 @@
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import case
+
+from app import db, rd
+from app.cache import make_key
+from app.models import Movie, PlaynumFlush
+
+# 尚未写回数据库的播放量，field为电影编号
+PENDING_KEY = make_key("playnum", "pending")
+FLUSHING_KEY = make_key("playnum", "flushing")
+BATCH_KEY = make_key("playnum", "batch")  # flushing对应的批次编号
+LOCK_KEY = make_key("playnum", "lock")
+
+
+def incr(movie_id, amount=1):
+    """ 累加播放量，由flush批量写回数据库，返回尚未写回的播放量（含正在写回的） """
+    pipe = rd.pipeline()
+    pipe.hincrby(PENDING_KEY, movie_id, amount)
+    pipe.hget(FLUSHING_KEY, movie_id)
+    value, flushing = pipe.execute()
+    return value + int(flushing or 0)
+
+
+def pending(movie_id):
+    """ 单部电影尚未写回的播放量 """
+    return pending_many([movie_id])[movie_id]
+
+
+def pending_many(ids):
+    """ 多部电影尚未写回的播放量（含正在写回的），返回 {电影编号: 播放量} """
+    if not ids:
+        return {}
+    pipe = rd.pipeline()
+    pipe.hmget(PENDING_KEY, ids)
+    pipe.hmget(FLUSHING_KEY, ids)
+    values, flushing = pipe.execute()
+    return {k: int(v or 0) + int(f or 0) for k, v, f in zip(ids, values, flushing)}
+
+
+def flush():
+    """ 把累计的播放量用一条UPDATE ... CASE写回数据库，返回更新的电影数 """
+    if not rd.set(LOCK_KEY, 1, nx=True, ex=60):
+        return 0
+    try:
+        # 上一次写回失败时flushing中的数据还在，先把它处理完
+        if not rd.exists(FLUSHING_KEY):
+            if not rd.exists(PENDING_KEY):
+                return 0
+            # 改名后新的播放量会累加到新的哈希中，批次编号与数据一起生成
+            pipe = rd.pipeline()
+            pipe.rename(PENDING_KEY, FLUSHING_KEY)
+            pipe.set(BATCH_KEY, uuid.uuid4().hex)
+            pipe.execute()
+        batch = rd.get(BATCH_KEY)
+        if batch is None:  # 旧版本留下的flushing没有批次编号
+            batch = uuid.uuid4().hex
+            rd.set(BATCH_KEY, batch)
+        batch = batch.decode() if isinstance(batch, bytes) else batch
+        deltas = {int(k): int(v) for k, v in rd.hgetall(FLUSHING_KEY).items()}
+        # 批次编号与播放量在同一个事务中写入，提交后删除Redis数据失败时下次不会重复累加
+        applied = deltas and PlaynumFlush.query.get(batch) is None
+        if applied:
+            Movie.query.filter(
+                Movie.id.in_(list(deltas))
+            ).update(
+                {Movie.playnum: Movie.playnum + case(deltas, value=Movie.id, else_=0)},
+                synchronize_session=False
+            )
+            db.session.add(PlaynumFlush(batch=batch))
+            PlaynumFlush.query.filter(
+                PlaynumFlush.addtime < datetime.now() - timedelta(days=1)
+            ).delete(synchronize_session=False)
+            db.session.commit()
+        rd.delete(FLUSHING_KEY, BATCH_KEY)
+        return len(deltas) if applied else 0
+    finally:
+        rd.delete(LOCK_KEY)
+
+
+if __name__ == "__main__":
+    print("flushed %d movie(s)" % flush())
@@ -0,0 +1,295 @@
+import datetime
+import json
+import queue
+import threading
+import time
+
+from app import app, db, rd
+from app.cache import make_key, bump_version
+from app.models import Danmaku
+
+# 弹幕数超过热数据上限、等待归档的电影
+OVERFLOW_KEY = make_key("danmaku", "overflow")
+LOCK_KEY = make_key("danmaku", "lock")
+LEGACY_DONE_KEY = make_key("danmaku", "legacy", "done")
+
+legacy_checked = False  # 本进程是否已确认旧版弹幕迁移完成
+
+
+def danmaku_key(movie_id):
+    """ 按播放时间排序的弹幕有序集合 """
+    return make_key("danmaku", movie_id)
+
+
+def version_name(movie_id):
+    """ 弹幕数据版本号，用于条件GET """
+    return make_key("danmaku", movie_id)
+
+
+def log_key(movie_id):
+    """ 按发送顺序排列的弹幕列表，最新的在最前，用于找出最旧的弹幕归档 """
+    return make_key("danmaku", "log", movie_id)
+
+
+def channel_key(movie_id):
+    """ 新弹幕的发布频道 """
+    return make_key("danmaku", "channel", movie_id)
+
+
+def legacy_key(movie_id):
+    """ 旧版弹幕列表 """
+    return "movie" + str(movie_id)
+
+
+def migrate_legacy(movie_id):
+    """ 把旧版列表中的弹幕迁移到有序集合 """
+    legacy = legacy_key(movie_id)
+    if not rd.exists(legacy):
+        return 0
+    msgs = rd.lrange(legacy, 0, -1)
+    pipe = rd.pipeline()
+    for raw in msgs:
+        pipe.zadd(danmaku_key(movie_id), float(json.loads(raw.decode("utf-8"))["time"]), raw)
+    if msgs:
+        pipe.rpush(log_key(movie_id), *msgs)
+    if len(msgs) > app.config["DANMAKU_HOT_SIZE"]:
+        pipe.sadd(OVERFLOW_KEY, movie_id)
+    pipe.delete(legacy)
+    pipe.execute()
+    bump_version(version_name(movie_id))
+    return len(msgs)
+
+
+def migrate_all():
+    """ 迁移全部旧版弹幕列表，完成后记下标记 """
+    count = 0
+    for key in rd.scan_iter("movie*"):
+        movie_id = key.decode("utf-8")[len("movie"):]
+        if movie_id.isdigit():
+            count += migrate_legacy(movie_id)
+    rd.set(LEGACY_DONE_KEY, 1)
+    return count
+
+
+def ensure_migrated():
+    """ 每个进程只检查一次旧版弹幕是否已迁移，不在每次读取时访问Redis """
+    global legacy_checked
+    if legacy_checked:
+        return
+    if not rd.exists(LEGACY_DONE_KEY):
+        migrate_all()
+    legacy_checked = True
+
+
+def clamp(limit):
+    """ 每次返回的弹幕数限制在1到DANMAKU_MAX之间 """
+    if not limit:
+        return app.config["DANMAKU_MAX"]
+    return max(1, min(limit, app.config["DANMAKU_MAX"]))
+
+
+def add(movie_id, msg):
+    """ 保存一条弹幕，返回存储的JSON """
+    raw = json.dumps(msg)
+    pipe = rd.pipeline()
+    pipe.zadd(danmaku_key(movie_id), float(msg["time"]), raw)
+    pipe.lpush(log_key(movie_id), raw)
+    pipe.publish(channel_key(movie_id), raw)
+    count = pipe.execute()[1]
+    bump_version(version_name(movie_id))
+    if count > app.config["DANMAKU_HOT_SIZE"]:
+        rd.sadd(OVERFLOW_KEY, movie_id)
+    return raw
+
+
+def archive_movie(movie_id):
+    """ 把一部电影超出热数据上限的最旧弹幕批量写入MySQL，并从Redis中移除 """
+    try:
+        movie_id = int(movie_id)
+    except ValueError:
+        # 无效的编号无法归档，移出待归档集合，不影响其他电影
+        app.logger.warning("danmaku archive: invalid movie id %r", movie_id)
+        rd.srem(OVERFLOW_KEY, movie_id)
+        return 0
+    hot = app.config["DANMAKU_HOT_SIZE"]
+    batch = app.config["DANMAKU_ARCHIVE_BATCH"]
+    total = 0
+    while True:
+        overflow = rd.llen(log_key(movie_id)) - hot
+        if overflow <= 0:
+            break
+        msgs = rd.lrange(log_key(movie_id), -min(overflow, batch), -1)
+        parsed = [(raw, json.loads(raw.decode("utf-8"))) for raw in msgs]
+        # 写入后移除前中断时会重复归档，跳过已经写入的弹幕
+        done = set(v.uid for v in db.session.query(Danmaku.uid).filter(
+            Danmaku.uid.in_([msg["_id"] for raw, msg in parsed])
+        ))
+        rows = [dict(
+            movie_id=movie_id,
+            time=float(msg["time"]),
+            uid=msg["_id"],
+            content=raw.decode("utf-8"),
+            addtime=datetime.datetime.now()
+        ) for raw, msg in parsed if msg["_id"] not in done]
+        if rows:
+            try:
+                db.session.execute(Danmaku.__table__.insert(), rows)
+                db.session.commit()
+            except Exception:
+                # 写入失败时弹幕留在Redis中，下次归档重试
+                db.session.rollback()
+                app.logger.exception("danmaku archive of movie %s failed", movie_id)
+                return total
+        pipe = rd.pipeline()
+        pipe.zrem(danmaku_key(movie_id), *msgs)
+        # 新弹幕从头部插入，按尾部位置裁剪不会误删
+        pipe.ltrim(log_key(movie_id), 0, -len(msgs) - 1)
+        pipe.execute()
+        bump_version(version_name(movie_id))
+        total += len(msgs)
+    rd.srem(OVERFLOW_KEY, movie_id)
+    return total
+
+
+def remove(movie_id):
+    """ 删除一部电影的全部弹幕，归档的行随电影删除的事务一起提交 """
+    Danmaku.query.filter(Danmaku.movie_id == int(movie_id)).delete(synchronize_session=False)
+    pipe = rd.pipeline()
+    pipe.delete(danmaku_key(movie_id), log_key(movie_id), legacy_key(movie_id))
+    pipe.srem(OVERFLOW_KEY, movie_id)
+    pipe.execute()
+
+
+def archive():
+    """ 归档所有超出热数据上限的电影，返回归档的弹幕数 """
+    if not rd.set(LOCK_KEY, 1, nx=True, ex=300):
+        return 0
+    try:
+        total = 0
+        for movie_id in rd.smembers(OVERFLOW_KEY):
+            try:
+                total += archive_movie(movie_id.decode("utf-8"))
+            except Exception:
+                # 一部电影归档出错时继续归档其他电影
+                db.session.rollback()
+                app.logger.exception("danmaku archive of movie %s failed", movie_id)
+        return total
+    finally:
+        rd.delete(LOCK_KEY)
+
+
+def archived(movie_id, start=None, end=None, limit=None):
+    """ 从归档中读取[start, end]秒之间的弹幕，返回存储的JSON列表 """
+    limit = clamp(limit)
+    query = db.session.query(Danmaku.content).filter(Danmaku.movie_id == int(movie_id))
+    if start is not None:
+        query = query.filter(Danmaku.time >= start)
+    if end is not None:
+        query = query.filter(Danmaku.time <= end)
+    rows = query.order_by(Danmaku.time.asc()).limit(limit).all()
+    return [v.content.encode("utf-8") for v in rows]
+
+
+def fetch(movie_id, start=None, end=None, limit=None):
+    """ 读取[start, end]秒之间的弹幕，返回存储的JSON列表；不传时间窗口时返回最新的弹幕 """
+    limit = clamp(limit)
+    ensure_migrated()
+    if start is None and end is None:
+        return rd.lrange(log_key(movie_id), 0, limit - 1)
+    return rd.zrangebyscore(
+        danmaku_key(movie_id),
+        "-inf" if start is None else start,
+        "+inf" if end is None else end,
+        start=0,
+        num=limit
+    )
+
+
+def render(msgs):
+    """ 把存储的JSON原样拼接成DPlayer的响应，不做反序列化 """
+    return b'{"code": 1, "danmaku": [' + b", ".join(msgs) + b"]}"
+
+
+def stream(msgs):
+    """ 以生成器逐条输出响应，适合弹幕很多时边读边发 """
+    yield b'{"code": 1, "danmaku": ['
+    for i, raw in enumerate(msgs):
+        yield raw if i == 0 else b", " + raw
+    yield b"]}"
+
+
+class Hub(object):
+    """ 每个进程只保持一个Redis订阅连接，把新弹幕分发给本进程内的推送连接 """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.thread = None
+
+    def join(self, movie_id):
+        """ 登记一个推送连接，返回接收新弹幕的队列 """
+        q = queue.Queue(maxsize=app.config["DANMAKU_STREAM_BUFFER"])
+        with self.lock:
+            self.clients.setdefault(str(movie_id), set()).add(q)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="danmaku-hub")
+                self.thread.daemon = True
+                self.thread.start()
+        return q
+
+    def leave(self, movie_id, q):
+        with self.lock:
+            clients = self.clients.get(str(movie_id))
+            if clients is not None:
+                clients.discard(q)
+                if not clients:
+                    del self.clients[str(movie_id)]
+
+    def dispatch(self, message):
+        movie_id = message["channel"].decode("utf-8").rsplit(":", 1)[-1]
+        for q in list(self.clients.get(movie_id, ())):
+            try:
+                q.put_nowait(message["data"])
+            except queue.Full:  # 客户端太慢时丢弃，不影响其他连接
+                pass
+
+    def run(self):
+        while True:
+            try:
+                pubsub = rd.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(channel_key("*"))
+                for message in pubsub.listen():
+                    if message["type"] == "pmessage":
+                        self.dispatch(message)
+            except Exception:
+                app.logger.exception("danmaku hub disconnected")
+                time.sleep(1)
+
+
+hub = Hub()
+
+
+def subscribe(movie_id):
+    """ 以Server-Sent Events格式持续输出新弹幕 """
+    q = hub.join(movie_id)
+    try:
+        yield b"retry: 3000\n\n"
+        while True:
+            try:
+                raw = q.get(timeout=app.config["DANMAKU_STREAM_HEARTBEAT"])
+            except queue.Empty:
+                # 心跳，同时让服务器及时发现已断开的连接
+                yield b": ping\n\n"
+                continue
+            yield b"data: " + raw + b"\n\n"
+    finally:
+        hub.leave(movie_id, q)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["archive"]:
+        print("archived %d danmaku" % archive())
+        sys.exit(0)
+    print("migrated %d danmaku" % migrate_all())
@@ -0,0 +1,59 @@
+from app import db
+from app.models import Movie, Comment, Moviecol, Userlog, Oplog, LoginlogDaily
+
+
+def view_queries():
+    """ 各视图的代表性查询，(视图, 说明, 查询) """
+    queries = [
+        ("home.index", "按添加时间", Movie.query.order_by(Movie.addtime.desc(), Movie.id.desc())),
+        ("home.index", "按播放量", Movie.query.order_by(Movie.playnum.desc(), Movie.id.desc())),
+        ("home.index", "按评论量", Movie.query.order_by(Movie.commentnum.desc(), Movie.id.desc())),
+    ]
+    for column in (Movie.addtime, Movie.playnum, Movie.commentnum):
+        queries.append((
+            "home.index", "标签+星级，按%s" % column.key,
+            Movie.query.filter_by(tag_id=1, star=1).order_by(column.desc(), Movie.id.desc())
+        ))
+    queries += [
+        ("home.play", "电影评论", Comment.query.filter_by(movie_id=1).order_by(Comment.addtime.desc(), Comment.id.desc())),
+        ("home.comments", "会员评论", Comment.query.filter_by(user_id=1).order_by(Comment.addtime.desc(), Comment.id.desc())),
+        ("home.moviecol", "会员收藏", Moviecol.query.filter_by(user_id=1).order_by(Moviecol.addtime.desc(), Moviecol.id.desc())),
+        ("home.loginlog", "会员登录日志", Userlog.query.filter_by(user_id=1).order_by(Userlog.addtime.desc(), Userlog.id.desc())),
+        ("admin.comment_list", "全部评论", Comment.query.order_by(Comment.addtime.desc(), Comment.id.desc())),
+        ("admin.moviecol_list", "全部收藏", Moviecol.query.order_by(Moviecol.addtime.desc(), Moviecol.id.desc())),
+        ("admin.userloginlog_list", "会员登录汇总", LoginlogDaily.query.filter_by(kind="user").order_by(LoginlogDaily.day.desc(), LoginlogDaily.id.desc())),
+        ("admin.adminloginlog_list", "管理员登录汇总", LoginlogDaily.query.filter_by(kind="admin").order_by(LoginlogDaily.day.desc(), LoginlogDaily.id.desc())),
+        ("admin.oplog_list", "操作日志", Oplog.query.order_by(Oplog.addtime.desc(), Oplog.id.desc())),
+    ]
+    return [(endpoint, name, query.limit(10)) for endpoint, name, query in queries]
+
+
+def explain(query):
+    """ 返回查询的执行计划（MySQL EXPLAIN） """
+    statement = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True})
+    result = db.session.execute("EXPLAIN " + str(statement))
+    keys = [v.lower() for v in result.keys()]
+    return [dict(zip(keys, row)) for row in result.fetchall()]
+
+
+def check():
+    """ 找出没有使用索引或需要filesort的查询 """
+    problems = []
+    for endpoint, name, query in view_queries():
+        for row in explain(query):
+            extra = row.get("extra") or ""
+            if row.get("key") is None or row.get("type") == "ALL" or "filesort" in extra:
+                problems.append((endpoint, name, row))
+    return problems
+
+
+if __name__ == "__main__":
+    import sys
+
+    problems = check()
+    for endpoint, name, row in problems:
+        print("%s %s: table=%s type=%s key=%s extra=%s" % (
+            endpoint, name, row.get("table"), row.get("type"), row.get("key"), row.get("extra")
+        ))
+    print("%d problem(s)" % len(problems))
+    sys.exit(1 if problems else 0)
@@ -1,16 +1,21 @@
 import datetime
 import json
-import os
 import uuid
 from functools import wraps
 
-from flask import render_template, redirect, url_for, flash, session, request, Response
+from flask import render_template, redirect, url_for, flash, session, request, Response, abort, jsonify
+from flask_sqlalchemy import Pagination
+from sqlalchemy.orm import contains_eager
 from werkzeug.security import generate_password_hash
-from werkzeug.utils import secure_filename
 
-from app import db, app, rd
+from app import db, ranking, counter, danmaku, logqueue, suggest, storage, images, media as media_file, \
+    search as search_index
+from app.cache import make_key, get_version, get_json, set_json
+from app.conditional import conditional
 from app.home.forms import RegistForm, LoginForm, UserdetailForm, PwdForm, CommentForm
 from app.models import User, Userlog, Preview, Movie, Tag, Comment, Moviecol
+from app.pagination import paginate, is_keyset, split_order, KeysetPagination
+from app.querybudget import query_budget
 from . import home
 
 
@@ -25,13 +30,6 @@ def user_login_req(f):
     return decorated_function
 
 
-# 修改文件名称
-def change_filename(filename):
-    fileinfo = os.path.splitext(filename)
-    filename = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + str(uuid.uuid4().hex) + fileinfo[-1]
-    return filename
-
-
 @home.route("/login/", methods=["GET", "POST"])
 def login():
     """ 登录 """
@@ -44,12 +42,11 @@ def login():
             return redirect(url_for("home.login"))
         session["user"] = user.name
         session["user_id"] = user.id
-        userlog = Userlog(
+        logqueue.enqueue(
+            "userlog",
             user_id=user.id,
             ip=request.remote_addr
         )
-        db.session.add(userlog)
-        db.session.commit()
         return redirect(url_for("home.user"))
     return render_template("home/login.html", form=form)
 
@@ -96,11 +93,10 @@ def user():
         form.info.data = user.info
     if form.validate_on_submit():
         data = form.data
-        file_face = secure_filename(form.face.data.filename)
-        if not os.path.exists(app.config["FC_DIR"]):
-            os.makedirs(app.config["FC_DIR"])
-        user.face = change_filename(file_face)
-        form.face.data.save(app.config["FC_DIR"] + user.face)
+        old_face = user.face
+        if form.face.data.filename != "":  # 上传了新头像
+            user.face = storage.save(form.face.data, "FC_DIR")
+            images.generate(user.face, "avatar")
 
         name_count = User.query.filter_by(name=data["name"]).count()
         if data["name"] != user.name and name_count == 1:
@@ -123,6 +119,7 @@ def user():
         user.info = data["info"]
         db.session.add(user)
         db.session.commit()
+        storage.release("FC_DIR", old_face)
         flash("修改成功！", "ok")
         return redirect(url_for("home.user"))
     return render_template("home/user.html", form=form, user=user)
@@ -149,47 +146,53 @@ def pwd():
 
 @home.route("/comments/<int:page>/")
 @user_login_req
+@query_budget(3)
 def comments(page=1):
     """ 评论列表 """
-    page_data = Comment.query.join(
+    query = Comment.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == Comment.movie_id,
         User.id == session["user_id"]
-    ).order_by(
-        Comment.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Comment.movie),
+        contains_eager(Comment.user)
+    )
+    page_data = paginate(query, [Comment.addtime.desc(), Comment.id.desc()], page, 10)
     return render_template("home/comments.html", page_data=page_data)
 
 
 @home.route("/loginlog/<int:page>/", methods=["GET"])
 @user_login_req
+@query_budget(3)
 def loginlog(page=1):
     """ 登录日志 """
-    page_data = Userlog.query.filter_by(
+    query = Userlog.query.filter_by(
         user_id=int(session["user_id"])
-    ).order_by(
-        Userlog.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    )
+    page_data = paginate(query, [Userlog.addtime.desc(), Userlog.id.desc()], page, 10)
     return render_template("home/loginlog.html", page_data=page_data)
 
 
 @home.route("/moviecol/<int:page>/")
 @user_login_req
+@query_budget(3)
 def moviecol(page=1):
     """ 电影收藏 """
-    page_data = Moviecol.query.join(
+    query = Moviecol.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == Moviecol.movie_id,
         User.id == session["user_id"]
-    ).order_by(
-        Moviecol.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Moviecol.movie),
+        contains_eager(Moviecol.user)
+    )
+    page_data = paginate(query, [Moviecol.addtime.desc(), Moviecol.id.desc()], page, 10)
     return render_template("home/moviecol.html", page_data=page_data)
 
 
@@ -219,56 +222,35 @@ def moviecol_add():
     return json.dumps(data)
 
 
+def movie_items(ids):
+    """ 按编号顺序取出电影 """
+    movies = {}
+    if ids:
+        movies = {v.id: v for v in Movie.query.filter(Movie.id.in_(ids)).all()}
+    return [movies[v] for v in ids if v in movies]
+
+
 @home.route("/<int:page>/", methods=["GET"])
 @home.route("/", methods=["GET"])
 def index(page=1):
     """ 首页 """
-    tags = Tag.query.all()
-    page_data = Movie.query
+    if page is None:
+        page = 1
+    version = get_version("catalog")
+    tags = get_json(make_key("tags", version))
+    if tags is None:
+        tags = [dict(id=v.id, name=v.name) for v in Tag.query.all()]
+        set_json(make_key("tags", version), tags)
     # 标签
     tid = request.args.get("tid", 0)
-    if int(tid) != 0:
-        page_data = page_data.filter_by(tag_id=int(tid))
     # 星级
     star = request.args.get("star", 0)
-    if int(star) != 0:
-        page_data = page_data.filter_by(star=int(star))
     # 时间
     time = request.args.get("time", 0)
-    if int(time) != 0:
-        if int(time) == 1:
-            page_data = page_data.order_by(
-                Movie.addtime.desc()
-            )
-        else:
-            page_data = page_data.order_by(
-                Movie.addtime.asc()
-            )
     # 播放量
     pm = request.args.get("pm", 0)
-    if int(pm) != 0:
-        if int(pm) == 1:
-            page_data = page_data.order_by(
-                Movie.playnum.desc()
-            )
-        else:
-            page_data = page_data.order_by(
-                Movie.playnum.asc()
-            )
     # 评论量
     cm = request.args.get("cm", 0)
-    if int(cm) != 0:
-        if int(cm) == 1:
-            page_data = page_data.order_by(
-                Movie.commentnum.desc()
-            )
-        else:
-            page_data = page_data.order_by(
-                Movie.commentnum.asc()
-            )
-    if page is None:
-        page = 1
-    page_data = page_data.paginate(page=page, per_page=8)
     p = dict(
         tid=tid,
         star=star,
@@ -276,6 +258,59 @@ def index(page=1):
         pm=pm,
         cm=cm,
     )
+    keyset = is_keyset()
+    if not keyset and int(star) == 0 and int(time) == 0 and (int(pm) != 0) != (int(cm) != 0):
+        # 只按播放量或评论量排序时直接读取Redis排行
+        if int(pm) != 0:
+            ids, total = ranking.page("playnum", int(tid), page, 8, desc=int(pm) == 1)
+        else:
+            ids, total = ranking.page("commentnum", int(tid), page, 8, desc=int(cm) == 1)
+        if page > 1 and not ids:
+            abort(404)
+        page_data = Pagination(None, page, 8, total, movie_items(ids))
+        return render_template("home/index.html", tags=tags, p=p, page_data=page_data)
+    key = make_key(
+        "index", version, int(tid), int(star), int(time), int(pm), int(cm),
+        "k" if keyset else "p", page, request.args.get("after", ""), request.args.get("before", "")
+    )
+    data = get_json(key)
+    if data is None:
+        page_data = Movie.query
+        orders = []
+        if int(tid) != 0:
+            page_data = page_data.filter_by(tag_id=int(tid))
+        if int(star) != 0:
+            page_data = page_data.filter_by(star=int(star))
+        if int(time) != 0:
+            if int(time) == 1:
+                orders.append(Movie.addtime.desc())
+            else:
+                orders.append(Movie.addtime.asc())
+        if int(pm) != 0:
+            if int(pm) == 1:
+                orders.append(Movie.playnum.desc())
+            else:
+                orders.append(Movie.playnum.asc())
+        if int(cm) != 0:
+            if int(cm) == 1:
+                orders.append(Movie.commentnum.desc())
+            else:
+                orders.append(Movie.commentnum.asc())
+        # 主键作为最后的排序键，方向与前一个排序键一致以便走索引
+        if orders and split_order(orders[-1])[1]:
+            orders.append(Movie.id.desc())
+        else:
+            orders.append(Movie.id.asc())
+        page_data = paginate(page_data, orders, page, 8)
+        # 只缓存当前页的电影编号、总数和游标
+        data = dict(ids=[v.id for v in page_data.items], total=page_data.total)
+        if keyset:
+            data.update(next=page_data.next_cursor, prev=page_data.prev_cursor)
+        set_json(key, data)
+    elif keyset:
+        page_data = KeysetPagination(movie_items(data["ids"]), 8, data["next"], data["prev"], data["total"])
+    else:
+        page_data = Pagination(None, page, 8, data["total"], movie_items(data["ids"]))
     return render_template("home/index.html", tags=tags, p=p, page_data=page_data)
 
 
@@ -290,38 +325,53 @@ def animation():
 def search(page=1):
     """ 搜索 """
     key = request.args.get("key", "")
-    movie_count = Movie.query.filter(
-        Movie.title.ilike('%' + key + '%')
-    ).count()
-    page_data = Movie.query.filter(
-        Movie.title.ilike('%' + key + '%')
-    ).order_by(
-        Movie.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    if key.strip():
+        items, movie_count = search_index.results(key, page, 10)
+        if not items and page != 1:  # 超出最后一页，与分页查询一样返回404
+            abort(404)
+        page_data = Pagination(None, page, 10, movie_count, items)
+    else:
+        query = Movie.query
+        page_data = paginate(query, [Movie.addtime.desc(), Movie.id.desc()], page, 10)
+        movie_count = page_data.total if page_data.total is not None else Movie.query.count()
     page_data.key = key
     return render_template("home/search.html", movie_count=movie_count, key=key, page_data=page_data)
 
 
+@home.route("/search/suggest/")
+def search_suggest():
+    """ 搜索补全 """
+    key = request.args.get("key", "")
+    items = [dict(id=id, title=title) for id, title in suggest.suggest(key)]
+    return jsonify(key=key, items=items)
+
+
 @home.route("/play/<int:id>/<int:page>/", methods=["GET", "POST"])
+@query_budget(5)
 def play(id=None, page=1):
     """ 播放 """
     movie = Movie.query.join(Tag).filter(
         Tag.id == Movie.tag_id,
         Movie.id == int(id)
+    ).options(
+        contains_eager(Movie.tag)
     ).first_or_404()
 
-    page_data = Comment.query.join(
+    query = Comment.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == movie.id,
         User.id == Comment.user_id
-    ).order_by(
-        Comment.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Comment.user)
+    )
+    page_data = paginate(query, [Comment.addtime.desc(), Comment.id.desc()], page, 10)
 
-    movie.playnum = movie.playnum + 1
+    # 播放量先累加在Redis中，由后台任务批量写回数据库
+    playnum = movie.playnum + counter.incr(movie.id)
+    ranking.incr(movie, "playnum")
     form = CommentForm()
     if "user" in session and form.validate_on_submit():
         data = form.data
@@ -331,37 +381,41 @@ def play(id=None, page=1):
             user_id=session["user_id"]
         )
         db.session.add(comment)
-        db.session.commit()
-        movie.commentnum = movie.commentnum + 1
-        db.session.add(movie)
+        # 评论数在数据库中原子累加，提交后不再重新加载已过期的电影
+        Movie.query.filter_by(id=movie.id).update(
+            {Movie.commentnum: Movie.commentnum + 1}, synchronize_session=False
+        )
+        ranking.incr(movie, "commentnum")
         db.session.commit()
         flash("添加评论成功！", "ok")
-        return redirect(url_for('home.play', id=movie.id, page=1))
-    db.session.add(movie)
-    db.session.commit()
-    return render_template("home/play.html", movie=movie, form=form, page_data=page_data)
+        return redirect(url_for('home.play', id=id, page=1))
+    return render_template("home/play.html", movie=movie, playnum=playnum, form=form, page_data=page_data)
 
 
 @home.route("/video/<int:id>/<int:page>/", methods=["GET", "POST"])
+@query_budget(5)
 def video(id=None, page=1):
     """ 弹幕视频播放 """
     movie = Movie.query.join(Tag).filter(
         Tag.id == Movie.tag_id,
         Movie.id == int(id)
+    ).options(
+        contains_eager(Movie.tag)
     ).first_or_404()
-    page_data = Comment.query.join(
+    query = Comment.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == movie.id,
         User.id == Comment.user_id
-    ).order_by(
-        Comment.addtime.desc()
-    ).paginate(page=page, per_page=10)
-    movie.playnum = movie.playnum + 1
-    db.session.add(movie)
-    db.session.commit()
+    ).options(
+        contains_eager(Comment.user)
+    )
+    page_data = paginate(query, [Comment.addtime.desc(), Comment.id.desc()], page, 10)
+    # 播放量先累加在Redis中，由后台任务批量写回数据库
+    playnum = movie.playnum + counter.incr(movie.id)
+    ranking.incr(movie, "playnum")
 
     form = CommentForm()
     if "user" in session and form.validate_on_submit():
@@ -372,38 +426,45 @@ def video(id=None, page=1):
             user_id=session["user_id"]
         )
         db.session.add(comment)
-        db.session.commit()
-        movie.commentnum = movie.commentnum + 1
-        db.session.add(movie)
+        # 评论数在数据库中原子累加，提交后不再重新加载已过期的电影
+        Movie.query.filter_by(id=movie.id).update(
+            {Movie.commentnum: Movie.commentnum + 1}, synchronize_session=False
+        )
+        ranking.incr(movie, "commentnum")
         db.session.commit()
         flash("添加评论成功！", "ok")
-        return redirect(url_for('home.video', id=movie.id, page=1))
-    return render_template("home/video.html", movie=movie, form=form, page_data=page_data)
+        return redirect(url_for('home.video', id=id, page=1))
+    return render_template("home/video.html", movie=movie, playnum=playnum, form=form, page_data=page_data)
+
+
+@home.route("/media/<path:filename>")
+def media(filename):
+    """ 视频文件，支持拖动进度条的分段请求 """
+    return media_file.send(filename)
 
 
 @home.route("/tm/", methods=["GET", "POST"])
+@conditional(lambda: danmaku.version_name(request.args.get('id')))
 def tm():
     """ 弹幕 """
     import json
     if request.method == "GET":
-        # 获取弹幕消息队列
+        # 获取弹幕，from/to为播放时间窗口（秒），不传则返回最新的弹幕
         id = request.args.get('id')
-        key = "movie" + str(id)
-        if rd.llen(key):
-            msgs = rd.lrange(key, 0, 2999)
-            res = {
-                "code": 1,
-                "danmaku": [json.loads(v) for v in msgs]
-            }
-        else:
-            res = {
-                "code": 1,
-                "danmaku": []
-            }
-        resp = json.dumps(res)
+        msgs = danmaku.fetch(
+            id,
+            start=request.args.get("from", type=float),
+            end=request.args.get("to", type=float),
+            limit=request.args.get("max", type=int)
+        )
+        resp = danmaku.render(msgs)
     else:
-        # 添加弹幕
+        # 添加弹幕，播放器编号即电影编号，会作为Redis键和归档的电影编号
         data = json.loads(request.get_data())
+        try:
+            movie_id = int(data["player"])
+        except (TypeError, ValueError):
+            abort(404)
         msg = {
             "__v": 0,
             "author": data["author"],
@@ -422,5 +483,35 @@ def tm():
             "data": msg
         }
         resp = json.dumps(res)
-        rd.lpush("movie" + str(data["player"]), json.dumps(msg))
+        danmaku.add(movie_id, msg)
     return Response(resp, mimetype='application/json')
+
+
+@home.route("/tm/archive/", methods=["GET"])
+@conditional(lambda: danmaku.version_name(request.args.get('id', type=int)))
+def tm_archive():
+    """ 已归档的弹幕 """
+    id = request.args.get('id', type=int)
+    if id is None:
+        abort(404)
+    msgs = danmaku.archived(
+        id,
+        start=request.args.get("from", type=float),
+        end=request.args.get("to", type=float),
+        limit=request.args.get("max", type=int)
+    )
+    return Response(danmaku.render(msgs), mimetype='application/json')
+
+
+@home.route("/tm/stream/", methods=["GET"])
+def tm_stream():
+    """ 弹幕实时推送 """
+    id = request.args.get('id')
+    return Response(
+        danmaku.subscribe(id),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # 关闭nginx缓冲
+        }
+    )
@@ -0,0 +1,122 @@
+import os
+
+from flask import url_for
+
+from app import app, db, storage
+from app.models import Movie, Preview, User
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # 没有安装Pillow时只保存原图，模板继续使用原图
+    Image = None
+
+# 各类图片：(保存目录的配置项, 静态文件路径前缀, {尺寸名: (宽, 高, 是否裁剪为固定尺寸)})
+KINDS = {
+    "cover": ("UP_DIR", "uploads/", {
+        "thumb": (262, 166, True),  # 搜索、收藏列表
+        "list": (420, 266, True),  # 首页电影列表、后台列表
+        "detail": (1280, 800, False),  # 轮播图、编辑页
+    }),
+    "avatar": ("FC_DIR", "uploads/users/", {
+        "thumb": (100, 100, True),  # 评论列表
+        "detail": (200, 200, True),  # 会员资料
+    }),
+}
+
+# (扩展名, Pillow格式)，模板优先使用WebP；Pillow没有编译WebP支持时只生成JPEG
+FORMATS = (("webp", "WEBP"), ("jpg", "JPEG"))
+if Image is not None and not features.check("webp"):
+    FORMATS = (("jpg", "JPEG"),)
+
+# 已生成的衍生图路径，文件按内容命名不会改变，确认存在后不再检查磁盘
+generated = set()
+
+
+def open_rgb(path):
+    """ 打开图片并转为RGB，透明部分填充白色 """
+    image = Image.open(path)
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert("RGB")
+
+
+def resize(image, width, height, crop):
+    if crop:
+        return ImageOps.fit(image, (width, height), Image.LANCZOS)
+    image = image.copy()
+    image.thumbnail((width, height), Image.LANCZOS)
+    return image
+
+
+def generate(name, kind):
+    """ 生成图片的各尺寸WebP和JPEG文件，已存在的跳过，返回生成的个数 """
+    key, prefix, sizes = KINDS[kind]
+    if Image is None or not storage.is_stored(name):
+        return 0
+    directory = app.config[key]
+    created = 0
+    try:  # 损坏或不支持的图片可能抛出各种异常，不能影响保存记录
+        image = open_rgb(os.path.join(directory, name))
+        for size, (width, height, crop) in sizes.items():
+            resized = None
+            for ext, format in FORMATS:
+                path = os.path.join(directory, storage.variant(name, size, ext))
+                if os.path.exists(path):
+                    continue
+                if resized is None:
+                    resized = resize(image, width, height, crop)
+                tmp = storage.temp_path(directory)
+                try:
+                    resized.save(tmp, format, quality=app.config["IMAGE_QUALITY"])
+                    os.rename(tmp, path)
+                    generated.add(path)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                created += 1
+    except Exception as e:
+        app.logger.warning("image %s: %s", name, e)
+    return created
+
+
+def exists(path):
+    """ 衍生图是否已生成，存在的结果缓存在进程内 """
+    if path in generated:
+        return True
+    if os.path.exists(path):
+        generated.add(path)
+        return True
+    return False
+
+
+@app.template_global()
+def image_urls(name, kind, size):
+    """ 图片某个尺寸的(WebP地址, JPEG地址)，还没有生成时使用原图 """
+    key, prefix, sizes = KINDS[kind]
+    original = url_for("static", filename=prefix + name)
+    if not storage.is_stored(name):
+        return None, original
+    urls = {}
+    for ext, format in FORMATS:
+        variant = storage.variant(name, size, ext)
+        if exists(os.path.join(app.config[key], variant)):
+            urls[ext] = url_for("static", filename=prefix + variant)
+    if "jpg" not in urls:
+        return None, original
+    return urls.get("webp"), urls["jpg"]
+
+
+def backfill():
+    """ 为已有的封面和头像生成缺少的尺寸，返回生成的文件数 """
+    created = 0
+    for kind, column in (("cover", Movie.logo), ("cover", Preview.logo), ("avatar", User.face)):
+        for name, in db.session.query(column).filter(column.isnot(None)).yield_per(1000):
+            created += generate(name, kind)
+    return created
+
+
+if __name__ == "__main__":
+    print("generated %d image(s)" % backfill())
@@ -0,0 +1,129 @@
+import logging
+import re
+import time
+
+from flask import g, has_request_context, request
+from jinja2 import Template
+from redis.client import StrictRedis, BasePipeline
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+
+slow_log = logging.getLogger("curly.slowquery")
+
+
+def stats():
+    """ 当前请求的计时数据，不在请求中时返回None """
+    if not has_request_context():
+        return None
+    data = g.get("timing")
+    if data is None:
+        data = g.timing = dict(db=0.0, db_count=0, redis=0.0, redis_count=0, tpl=0.0)
+    return data
+
+
+def normalize(statement):
+    """ 合并空白，把数字常量和IN列表替换成占位符，便于按语句归类 """
+    statement = re.sub(r"\s+", " ", statement).strip()
+    statement = re.sub(r"\b\d+(\.\d+)?\b", "?", statement)
+    return re.sub(r"IN \((\s*(%s|\?|:\w+)\s*,?)+\)", "IN (...)", statement, flags=re.I)
+
+
+def param_shape(parameters, executemany=False):
+    """ 绑定参数的结构：只记录参数名和类型，不记录值 """
+    if executemany and parameters:
+        return "%d x %s" % (len(parameters), param_shape(parameters[0]))
+    if isinstance(parameters, dict):
+        return "{%s}" % ", ".join("%s: %s" % (k, type(v).__name__) for k, v in sorted(parameters.items()))
+    if isinstance(parameters, (list, tuple)):
+        return "(%s)" % ", ".join(type(v).__name__ for v in parameters)
+    return type(parameters).__name__
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_start"] = time.time()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.time() - conn.info.pop("query_start")
+    data = stats()
+    if data is not None:
+        data["db"] += elapsed
+        data["db_count"] += 1
+    if elapsed >= app.config["SLOW_QUERY_THRESHOLD"]:
+        slow_log.warning(
+            "%.1fms endpoint=%s sql=%s params=%s",
+            elapsed * 1000,
+            request.endpoint if has_request_context() else None,
+            normalize(statement),
+            param_shape(parameters, executemany)
+        )
+
+
+def timed_redis(f, count):
+    """ 统计Redis命令数和耗时，count返回本次调用包含的命令数 """
+
+    def wrapper(self, *args, **kwargs):
+        data = stats()
+        if data is None:
+            return f(self, *args, **kwargs)
+        n = count(self)
+        start = time.time()
+        try:
+            return f(self, *args, **kwargs)
+        finally:
+            data["redis"] += time.time() - start
+            data["redis_count"] += n
+
+    wrapper.__name__ = f.__name__
+    return wrapper
+
+
+class TimedTemplate(Template):
+    """ 记录模板渲染耗时 """
+
+    def render(self, *args, **kwargs):
+        data = stats()
+        if data is None:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        start = time.time()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            data["tpl"] += time.time() - start
+
+
+def start_timer():
+    g.request_start = time.time()
+    g.timing = None
+    stats()
+
+
+def server_timing(response):
+    data = stats()
+    start = g.get("request_start")
+    if data is None or start is None:
+        return response
+    response.headers["Server-Timing"] = ", ".join([
+        'db;dur=%.1f;desc="%d queries"' % (data["db"] * 1000, data["db_count"]),
+        'redis;dur=%.1f;desc="%d commands"' % (data["redis"] * 1000, data["redis_count"]),
+        'tpl;dur=%.1f' % (data["tpl"] * 1000),
+        'total;dur=%.1f' % ((time.time() - start) * 1000),
+    ])
+    return response
+
+
+def install():
+    """ 挂载SQLAlchemy、Redis和模板的计时钩子，未开启时不调用，不产生开销 """
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    StrictRedis.execute_command = timed_redis(StrictRedis.execute_command, lambda client: 1)
+    BasePipeline.execute = timed_redis(BasePipeline.execute, lambda pipe: len(pipe.command_stack))
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(start_timer)
+    app.after_request(server_timing)
+    if app.config["SLOW_QUERY_LOG"]:
+        handler = logging.FileHandler(app.config["SLOW_QUERY_LOG"])
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_log.addHandler(handler)
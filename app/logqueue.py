@@ -0,0 +1,118 @@
+import datetime
+import json
+import time
+
+import redis
+
+from app import app, db, rd
+from app.cache import make_key
+from app.models import Userlog, Adminlog, Oplog
+
+# 待写入的日志，RPUSH到队尾，flush从队头批量取出
+QUEUE_KEY = make_key("logs", "queue")
+LOCK_KEY = make_key("logs", "lock")
+DEAD_KEY = make_key("logs", "dead")  # 无法写入的日志（如所属会员已删除），留待人工处理
+LOCK_TIMEOUT = 60
+EXIT_WAIT = 2  # 进程退出时等待其他进程释放锁的秒数
+
+MODELS = {
+    "userlog": Userlog,
+    "adminlog": Adminlog,
+    "oplog": Oplog,
+}
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def enqueue(kind, **fields):
+    """ 记录一条会员登录、管理员登录或操作日志，由flush批量写入数据库 """
+    fields.setdefault("addtime", datetime.datetime.now())
+    if not app.config["LOG_FLUSH_INTERVAL"]:
+        db.session.add(MODELS[kind](**fields))
+        db.session.commit()
+        return
+    fields["addtime"] = fields["addtime"].strftime(DATETIME_FORMAT)
+    rd.rpush(QUEUE_KEY, json.dumps(dict(kind=kind, fields=fields)))
+
+
+def parse(record):
+    record = json.loads(record.decode("utf-8"))
+    fields = record["fields"]
+    fields["addtime"] = datetime.datetime.strptime(fields["addtime"], DATETIME_FORMAT)
+    return record["kind"], fields
+
+
+def insert_one_by_one(records):
+    """ 整批写入失败时逐条写入，仍然失败的移到DEAD_KEY，避免一条坏日志堵住队列 """
+    for record in records:
+        try:
+            kind, fields = parse(record)
+            db.session.add(MODELS[kind](**fields))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("log record moved to %s", DEAD_KEY)
+            rd.rpush(DEAD_KEY, record)
+
+
+def acquire(wait=0):
+    """ 获取写入锁，最多等待wait秒 """
+    deadline = time.time() + wait
+    while not rd.set(LOCK_KEY, 1, nx=True, ex=LOCK_TIMEOUT):
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def flush(wait=0):
+    """ 按批从队列取出日志，用bulk_insert_mappings写入，返回写入条数；没拿到锁时返回None """
+    if not acquire(wait):
+        return None
+    batch = app.config["LOG_FLUSH_BATCH"]
+    # 只在锁的有效期的一半内取新的批次，剩下的留给下一次，避免锁过期后另一个进程重复写入
+    deadline = time.time() + LOCK_TIMEOUT / 2
+    total = 0
+    try:
+        while time.time() < deadline:
+            records = rd.lrange(QUEUE_KEY, 0, batch - 1)
+            if not records:
+                break
+            rows = {}
+            try:
+                for record in records:
+                    kind, fields = parse(record)
+                    rows.setdefault(kind, []).append(fields)
+                for kind, mappings in rows.items():
+                    db.session.bulk_insert_mappings(MODELS[kind], mappings)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                insert_one_by_one(records)
+            # 写入成功后才从队列中删除，新日志追加在队尾不受影响
+            rd.ltrim(QUEUE_KEY, len(records), -1)
+            total += len(records)
+            if len(records) < batch:
+                break
+    finally:
+        rd.delete(LOCK_KEY)
+    return total
+
+
+def flush_at_exit():
+    """ 进程退出前写入剩余日志，由periodic.start在启动后台写入时注册 """
+    with app.app_context():
+        try:
+            # 其他进程正在写入时短暂等待，仍然拿不到锁时日志留在队列中由其他进程写入
+            if flush(wait=EXIT_WAIT) is None:
+                app.logger.warning("%d log(s) left in %s at exit", rd.llen(QUEUE_KEY), QUEUE_KEY)
+        except redis.ConnectionError as e:
+            app.logger.warning("logs left in %s at exit: %s", QUEUE_KEY, e)
+        except Exception:
+            app.logger.exception("flushing logs at exit failed")
+        finally:
+            db.session.remove()
+
+
+if __name__ == "__main__":
+    print("flushed %d log(s)" % (flush() or 0))
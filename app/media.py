@@ -0,0 +1,89 @@
+import mimetypes
+import os
+from datetime import datetime
+
+from flask import request, Response, abort, safe_join
+from werkzeug.http import http_date, is_resource_modified
+from werkzeug.urls import url_quote
+from werkzeug.wsgi import wrap_file
+
+from app import app, storage
+
+
+def file_etag(stat):
+    """ 由文件大小和修改时间（纳秒）生成强校验值 """
+    return "%x-%x" % (stat.st_mtime_ns, stat.st_size)
+
+
+def read_range(f, start, stop, buffer_size):
+    """ 读取[start, stop)字节，每次最多buffer_size """
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(buffer_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def send(filename):
+    """ 发送上传目录中的文件，支持Range分段、条件请求，可交给前端代理发送 """
+    path = safe_join(app.config["UP_DIR"], filename)
+    if not os.path.isfile(path):
+        abort(404)
+    stat = os.stat(path)
+    etag = file_etag(stat)
+    mtime = datetime.utcfromtimestamp(stat.st_mtime)
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    mode = app.config["MEDIA_SENDFILE"]
+    if mode == "nginx":
+        # nginx按X-Accel-Redirect的内部地址发送文件，Range和条件请求也由nginx处理；地址中的文件名需要编码
+        response = Response(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = app.config["MEDIA_ACCEL_PREFIX"] + url_quote(filename, safe="/")
+        return response
+    if mode == "apache":
+        response = Response(mimetype=mimetype)
+        response.headers["X-Sendfile"] = path
+        return response
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": '"%s"' % etag,
+        "Last-Modified": http_date(stat.st_mtime),
+        "Cache-Control": "public, max-age=%d" % app.config["MEDIA_MAX_AGE"],
+    }
+    if storage.is_stored(filename):
+        # 按内容命名的文件不会改变
+        headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    if not is_resource_modified(request.environ, etag, last_modified=mtime):
+        return Response(status=304, headers=headers)
+
+    size = stat.st_size
+    start, stop, status = 0, size, 200
+    # 多段Range，或If-Range与当前文件不符时忽略Range，发送整个文件
+    if request.range is not None and len(request.range.ranges) == 1:
+        if "HTTP_IF_RANGE" not in request.environ or \
+                not is_resource_modified(request.environ, etag, last_modified=mtime, ignore_if_range=False):
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                headers["Content-Range"] = "bytes */%d" % size
+                return Response(status=416, headers=headers)
+            start, stop = byte_range
+            status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, stop - 1, size)
+    headers["Content-Length"] = str(stop - start)
+
+    f = open(path, "rb")
+    buffer_size = app.config["MEDIA_BUFFER_SIZE"]
+    if stop == size:
+        # 读到文件末尾时交给服务器的wsgi.file_wrapper，gunicorn等会用sendfile零拷贝发送
+        f.seek(start)
+        body = wrap_file(request.environ, f, buffer_size)
+    else:
+        body = read_range(f, start, stop, buffer_size)
+    return Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
@@ -0,0 +1,170 @@
+import json
+import os
+import resource
+import socket
+import threading
+import time
+
+from flask import g, request, Response, abort
+
+from app import app, db, rd
+
+# 请求耗时直方图的桶上限（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUESTS_KEY = "metrics:requests"  # 各进程累加的请求计数，字段为 端点|名称
+PROCESS_KEY = "metrics:process"  # 各进程的内存和连接池快照，字段为 主机:进程号
+
+lock = threading.Lock()
+pending = {}  # 尚未写入Redis的本进程计数
+
+
+def bucket(elapsed):
+    for le in BUCKETS:
+        if elapsed <= le:
+            return str(le)
+    return "+Inf"
+
+
+def observe(endpoint, elapsed, error=False):
+    """ 记录一次请求 """
+    with lock:
+        for name, amount in (("count", 1), ("sum", elapsed), ("le=" + bucket(elapsed), 1), ("errors", int(error))):
+            field = "%s|%s" % (endpoint, name)
+            pending[field] = pending.get(field, 0) + amount
+
+
+@app.before_request
+def start_timer():
+    g.metrics_start = time.time()
+
+
+@app.after_request
+def record(response):
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        observe(request.endpoint or "unmatched", time.time() - start, response.status_code >= 500)
+    return response
+
+
+@app.teardown_request
+def record_error(exc):
+    start = g.pop("metrics_start", None)
+    if start is not None and exc is not None:
+        observe(request.endpoint or "unmatched", time.time() - start, True)
+
+
+def rss():
+    """ 当前进程常驻内存（字节） """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def pool_stats():
+    """ 数据库连接池使用情况，非QueuePool时为空 """
+    pool = db.engine.pool
+    stats = {}
+    for name in ("size", "checkedout", "overflow"):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    return stats
+
+
+def flush():
+    """ 把本进程的计数累加到Redis，并更新进程快照，由后台任务定期调用 """
+    global pending
+    with lock:
+        data, pending = pending, {}
+    pipe = rd.pipeline(transaction=False)
+    for field, amount in data.items():
+        if isinstance(amount, float):
+            pipe.hincrbyfloat(REQUESTS_KEY, field, amount)
+        else:
+            pipe.hincrby(REQUESTS_KEY, field, amount)
+    process = dict(rss=rss(), pool=pool_stats(), time=time.time())
+    pipe.hset(PROCESS_KEY, "%s:%d" % (socket.gethostname(), os.getpid()), json.dumps(process))
+    pipe.execute()
+
+
+def collect():
+    """ 汇总所有进程的指标 """
+    flush()
+    endpoints = {}
+    for field, value in rd.hgetall(REQUESTS_KEY).items():
+        endpoint, name = field.decode("utf-8").rsplit("|", 1)
+        item = endpoints.setdefault(endpoint, dict(count=0, sum=0.0, errors=0, buckets={}))
+        if name.startswith("le="):
+            item["buckets"][name[3:]] = int(value)
+        elif name == "sum":
+            item["sum"] = float(value)
+        else:
+            item[name] = int(value)
+    for item in endpoints.values():
+        item["p95"] = quantile(item, 0.95)
+
+    # 超过3个写入周期没有更新的进程视为已退出
+    expire = time.time() - 3 * max(app.config["METRICS_FLUSH_INTERVAL"], 1)
+    processes = {}
+    for field, value in rd.hgetall(PROCESS_KEY).items():
+        process = json.loads(value.decode("utf-8"))
+        if process["time"] < expire:
+            rd.hdel(PROCESS_KEY, field)
+        else:
+            processes[field.decode("utf-8")] = process
+
+    return dict(
+        time=time.time(),
+        buckets=[str(v) for v in BUCKETS] + ["+Inf"],
+        endpoints=endpoints,
+        processes=processes,
+        redis_memory=rd.info("memory").get("used_memory"),
+    )
+
+
+def quantile(item, q):
+    """ 按直方图估算分位数，返回所在桶的上限 """
+    total = 0
+    for le in [str(v) for v in BUCKETS] + ["+Inf"]:
+        total += item["buckets"].get(le, 0)
+        if item["count"] and total >= q * item["count"]:
+            return float(le) if le != "+Inf" else None
+    return None
+
+
+def prometheus(data):
+    """ Prometheus文本格式 """
+    lines = [
+        "# TYPE curly_request_duration_seconds histogram",
+    ]
+    for endpoint, item in sorted(data["endpoints"].items()):
+        total = 0
+        for le in [str(v) for v in BUCKETS] + ["+Inf"]:
+            total += item["buckets"].get(le, 0)
+            lines.append('curly_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (endpoint, le, total))
+        lines.append('curly_request_duration_seconds_sum{endpoint="%s"} %f' % (endpoint, item["sum"]))
+        lines.append('curly_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, item["count"]))
+    lines.append("# TYPE curly_request_errors_total counter")
+    for endpoint, item in sorted(data["endpoints"].items()):
+        lines.append('curly_request_errors_total{endpoint="%s"} %d' % (endpoint, item["errors"]))
+    lines.append("# TYPE curly_process_resident_memory_bytes gauge")
+    for process, item in sorted(data["processes"].items()):
+        lines.append('curly_process_resident_memory_bytes{process="%s"} %d' % (process, item["rss"]))
+    for name in ("size", "checkedout", "overflow"):
+        lines.append("# TYPE curly_db_pool_%s gauge" % name)
+        for process, item in sorted(data["processes"].items()):
+            if name in item["pool"]:
+                lines.append('curly_db_pool_%s{process="%s"} %d' % (name, process, item["pool"][name]))
+    lines.append("# TYPE curly_redis_used_memory_bytes gauge")
+    lines.append("curly_redis_used_memory_bytes %d" % (data["redis_memory"] or 0))
+    return "\n".join(lines) + "\n"
+
+
+@app.route("/metrics")
+def metrics():
+    """ 供Prometheus抓取，只允许配置中的地址访问 """
+    if request.remote_addr not in app.config["METRICS_ALLOW"]:
+        abort(404)
+    return Response(prometheus(collect()), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,176 @@
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, inspect, select, func
+
+from app import app, db
+
+metadata = MetaData()
+
+# 已执行的迁移版本记录
+schema_version = Table(
+    "schema_version", metadata,
+    Column("version", Integer, primary_key=True),  # 版本号
+    Column("name", String(100)),  # 迁移名称
+    Column("addtime", DateTime, default=datetime.now)  # 执行时间
+)
+
+# 迁移列表，(版本号, 迁移函数)
+migrations = []
+
+
+def migration(version):
+    """ 注册迁移，迁移函数接收一个数据库连接，需能在部分已执行的库上重复运行 """
+
+    def decorator(f):
+        migrations.append((version, f))
+        return f
+
+    return decorator
+
+
+def has_table(conn, table):
+    return table in inspect(conn).get_table_names()
+
+
+def has_index(conn, table, name):
+    return name in [v["name"] for v in inspect(conn).get_indexes(table)]
+
+
+def has_column(conn, table, name):
+    return name in [v["name"] for v in inspect(conn).get_columns(table)]
+
+
+def create_indexes(conn, *tables):
+    """ 创建模型中声明但库中还不存在的索引 """
+    for table in tables:
+        for index in table.indexes:
+            if not has_index(conn, table.name, index.name):
+                index.create(conn)
+
+
+def current_version():
+    """ 当前数据库的迁移版本 """
+    with db.engine.begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+        return conn.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def upgrade():
+    """ 按版本号依次执行尚未执行的迁移 """
+    from app import models  # 确保所有模型已注册到db.metadata
+
+    version = current_version()
+    for number, f in sorted(migrations, key=lambda v: v[0]):
+        if number <= version:
+            continue
+        with db.engine.begin() as conn:
+            f(conn)
+            conn.execute(schema_version.insert().values(version=number, name=f.__name__))
+        app.logger.info("migration %s %s applied", number, f.__name__)
+    return current_version()
+
+
+@migration(1)
+def create_tables(conn):
+    """ 初始表结构，已有的表保持不变；之后新增的表由各自的迁移创建 """
+    from app.models import User, Userlog, Tag, Movie, Preview, Comment, Moviecol, Auth, Role, Admin, Adminlog, Oplog
+
+    tables = [User, Userlog, Tag, Movie, Preview, Comment, Moviecol, Auth, Role, Admin, Adminlog, Oplog]
+    db.metadata.create_all(bind=conn, tables=[v.__table__ for v in tables])
+
+
+@migration(2)
+def add_list_indexes(conn):
+    """ 电影筛选排序以及评论、收藏、日志列表的组合索引 """
+    from app.models import Movie, Comment, Moviecol, Userlog, Adminlog, Oplog
+
+    create_indexes(
+        conn,
+        Movie.__table__,
+        Comment.__table__,
+        Moviecol.__table__,
+        Userlog.__table__,
+        Adminlog.__table__,
+        Oplog.__table__
+    )
+
+
+@migration(3)
+def add_danmaku_archive(conn):
+    """ 弹幕归档表 """
+    from app.models import Danmaku
+
+    Danmaku.__table__.create(conn, checkfirst=True)
+    create_indexes(conn, Danmaku.__table__)
+
+
+@migration(4)
+def add_role_auth(conn):
+    """ 角色权限由逗号拼接的字符串改为关联表 """
+    from app.models import Auth, role_auth
+
+    role_auth.create(conn, checkfirst=True)
+    if not has_column(conn, "role", "auths"):
+        return
+    auth_ids = set(v.id for v in conn.execute(select([Auth.__table__.c.id])))
+    exists = set((v.role_id, v.auth_id) for v in conn.execute(select([role_auth])))
+    rows = []
+    for role_id, auths in conn.execute("SELECT id, auths FROM role"):
+        for auth_id in set(int(v) for v in (auths or "").split(",") if v.strip()):
+            if auth_id in auth_ids and (role_id, auth_id) not in exists:
+                rows.append(dict(role_id=role_id, auth_id=auth_id))
+    if rows:
+        conn.execute(role_auth.insert(), rows)
+    conn.execute("ALTER TABLE role DROP COLUMN auths")
+
+
+@migration(5)
+def add_log_retention(conn):
+    """ 日志归档表和登录日志按天汇总表 """
+    from app.models import LoginlogDaily, userlog_archive, adminlog_archive, oplog_archive
+
+    for table in (userlog_archive, adminlog_archive, oplog_archive, LoginlogDaily.__table__):
+        table.create(conn, checkfirst=True)
+        create_indexes(conn, table)
+
+
+def drop_unique(conn, table, column):
+    """ 删除只包含column一列的唯一索引 """
+    for index in inspect(conn).get_indexes(table):
+        if index["unique"] and index["column_names"] == [column]:
+            conn.execute("ALTER TABLE %s DROP INDEX %s" % (table, index["name"]))
+
+
+@migration(6)
+def add_content_storage(conn):
+    """ 文件按内容命名后不同记录可以引用同一个文件，唯一约束改为普通索引 """
+    from app.models import User, Movie, Preview
+
+    for table, column in (("movie", "url"), ("movie", "logo"), ("preview", "logo"), ("user", "face")):
+        drop_unique(conn, table, column)
+    create_indexes(conn, User.__table__, Movie.__table__, Preview.__table__)
+
+
+@migration(7)
+def add_playnum_flush(conn):
+    """ 播放量写回的批次记录，写回后删除Redis中的数据失败时不会重复累加 """
+    from app.models import PlaynumFlush
+
+    PlaynumFlush.__table__.create(conn, checkfirst=True)
+    create_indexes(conn, PlaynumFlush.__table__)
+
+
+@migration(8)
+def add_archive_log_id(conn):
+    """ 归档表使用自己的自增编号，原日志编号移到log_id，已归档的记录两者相同 """
+    from app.models import userlog_archive, adminlog_archive, oplog_archive
+
+    for table in (userlog_archive, adminlog_archive, oplog_archive):
+        if not has_column(conn, table.name, "log_id"):
+            conn.execute("ALTER TABLE %s ADD COLUMN log_id INTEGER" % table.name)
+            conn.execute("UPDATE %s SET log_id = id" % table.name)
+        create_indexes(conn, table)
+
+
+if __name__ == "__main__":
+    print("schema version %s" % upgrade())
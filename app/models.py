@@ -14,7 +14,7 @@ class User(db.Model):  # 会员
     email = db.Column(db.String(100), unique=True)  # 邮箱
     phone = db.Column(db.String(11), unique=True)  # 手机号码
     info = db.Column(db.Text)  # 个性简介
-    face = db.Column(db.String(255), unique=True)  # 头像
+    face = db.Column(db.String(255), index=True)  # 头像
     addtime = db.Column(db.DateTime, default=datetime.now)  # 注册时间
     uuid = db.Column(db.String(255), unique=True)  # 唯一标志符
     userlogs = db.relationship('Userlog', backref='user')  # 会员日志外键关系关联
@@ -30,7 +30,11 @@ class User(db.Model):  # 会员
 
 class Userlog(db.Model):  # 会员登录日志
     __tablename__ = "userlog"
-    __table_args__ = {"useexisting": True}
+    __table_args__ = (
+        db.Index("ix_userlog_user_addtime", "user_id", "addtime"),
+        db.Index("ix_userlog_addtime", "addtime"),
+        {"useexisting": True}
+    )
     id = db.Column(db.Integer, primary_key=True)  # 编号
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # 所属会员
     ip = db.Column(db.String(100))  # 登录IP
@@ -54,12 +58,20 @@ class Tag(db.Model):  # 标签
 
 class Movie(db.Model):  # 电影
     __tablename__ = "movie"
-    __table_args__ = {"useexisting": True}
+    __table_args__ = (
+        db.Index("ix_movie_tag_star_addtime", "tag_id", "star", "addtime"),
+        db.Index("ix_movie_tag_star_playnum", "tag_id", "star", "playnum"),
+        db.Index("ix_movie_tag_star_commentnum", "tag_id", "star", "commentnum"),
+        db.Index("ix_movie_addtime", "addtime"),
+        db.Index("ix_movie_playnum", "playnum"),
+        db.Index("ix_movie_commentnum", "commentnum"),
+        {"useexisting": True}
+    )
     id = db.Column(db.Integer, primary_key=True)  # 编号
     title = db.Column(db.String(255), unique=True)  # 标题
-    url = db.Column(db.String(255), unique=True)  # 地址
+    url = db.Column(db.String(255), index=True)  # 地址，按内容命名，相同的文件可以共用
     info = db.Column(db.Text)  # 简介
-    logo = db.Column(db.String(255), unique=True)  # 封面
+    logo = db.Column(db.String(255), index=True)  # 封面
     star = db.Column(db.SmallInteger)  # 星级
     playnum = db.Column(db.BigInteger, default=0)  # 播放量
     commentnum = db.Column(db.BigInteger, default=0)  # 评论量
@@ -80,7 +92,7 @@ class Preview(db.Model):  # 上映预告
     __table_args__ = {"useexisting": True}
     id = db.Column(db.Integer, primary_key=True)  # 编号
     title = db.Column(db.String(255), unique=True)  # 标题
-    logo = db.Column(db.String(255), unique=True)  # 封面
+    logo = db.Column(db.String(255), index=True)  # 封面
     addtime = db.Column(db.DateTime, default=datetime.now)  # 添加时间
 
     def __repr__(self):
@@ -89,7 +101,12 @@ class Preview(db.Model):  # 上映预告
 
 class Comment(db.Model):  # 评论
     __tablename__ = "comment"
-    __table_args__ = {"useexisting": True}
+    __table_args__ = (
+        db.Index("ix_comment_movie_addtime", "movie_id", "addtime"),
+        db.Index("ix_comment_user_addtime", "user_id", "addtime"),
+        db.Index("ix_comment_addtime", "addtime"),
+        {"useexisting": True}
+    )
     id = db.Column(db.Integer, primary_key=True)  # 编号
     content = db.Column(db.Text)  # 内容
     movie_id = db.Column(db.Integer, db.ForeignKey('movie.id'))  # 所属电影
@@ -100,9 +117,31 @@ class Comment(db.Model):  # 评论
         return "<Comment %r>" % self.id
 
 
+class Danmaku(db.Model):  # 弹幕归档
+    __tablename__ = "danmaku"
+    __table_args__ = (
+        db.Index("ix_danmaku_movie_time", "movie_id", "time"),
+        {"useexisting": True}
+    )
+    id = db.Column(db.Integer, primary_key=True)  # 编号
+    movie_id = db.Column(db.Integer, db.ForeignKey('movie.id'))  # 所属电影
+    time = db.Column(db.Float)  # 播放时间（秒）
+    uid = db.Column(db.String(100), unique=True)  # 弹幕唯一标志符
+    content = db.Column(db.Text)  # 弹幕原始JSON
+    addtime = db.Column(db.DateTime, default=datetime.now)  # 归档时间
+
+    def __repr__(self):
+        return "<Danmaku %r>" % self.id
+
+
 class Moviecol(db.Model):  # 电影收藏
     __tablename__ = "moviecol"
-    __table_args__ = {"useexisting": True}
+    __table_args__ = (
+        db.Index("ix_moviecol_user_addtime", "user_id", "addtime"),
+        db.Index("ix_moviecol_movie_addtime", "movie_id", "addtime"),
+        db.Index("ix_moviecol_addtime", "addtime"),
+        {"useexisting": True}
+    )
     id = db.Column(db.Integer, primary_key=True)  # 编号
     movie_id = db.Column(db.Integer, db.ForeignKey('movie.id'))  # 所属电影
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # 所属用户
@@ -124,18 +163,34 @@ class Auth(db.Model):  # 权限
         return "<Auth %r>" % self.name
 
 
+role_auth = db.Table(  # 角色权限关联
+    "role_auth",
+    db.Column("role_id", db.Integer, db.ForeignKey('role.id'), primary_key=True),  # 所属角色
+    db.Column("auth_id", db.Integer, db.ForeignKey('auth.id'), primary_key=True),  # 所属权限
+    useexisting=True
+)
+
+
 class Role(db.Model):  # 角色
     __tablename__ = "role"
     __table_args__ = {"useexisting": True}
     id = db.Column(db.Integer, primary_key=True)  # 编号
     name = db.Column(db.String(100), unique=True)  # 名称
-    auths = db.Column(db.String(600))  # 角色权限列表
     addtime = db.Column(db.DateTime, default=datetime.now)  # 添加时间
+    auths = db.relationship("Auth", secondary=role_auth, backref='roles')  # 角色权限列表
     admins = db.relationship("Admin", backref='role')  # 管理员外键关系关联
 
     def __repr__(self):
         return "<Role %r>" % self.name
 
+    @property
+    def auth_mask(self):
+        """ 权限位图，第n位为1表示拥有编号为n的权限 """
+        mask = 0
+        for v in self.auths:
+            mask |= 1 << v.id
+        return mask
+
 
 class Admin(db.Model):  # 管理员
     __tablename__ = "admin"
@@ -158,7 +213,11 @@ class Admin(db.Model):  # 管理员
 
 class Adminlog(db.Model):  # 管理员登录日志
     __tablename__ = "adminlog"
-    __table_args__ = {"useexisting": True}
+    __table_args__ = (
+        db.Index("ix_adminlog_admin_addtime", "admin_id", "addtime"),
+        db.Index("ix_adminlog_addtime", "addtime"),
+        {"useexisting": True}
+    )
     id = db.Column(db.Integer, primary_key=True)  # 编号
     admin_id = db.Column(db.Integer, db.ForeignKey('admin.id'))  # 所属管理员
     ip = db.Column(db.String(100))  # 登录IP
@@ -170,7 +229,11 @@ class Adminlog(db.Model):  # 管理员登录日志
 
 class Oplog(db.Model):  # 操作日志
     __tablename__ = "oplog"
-    __table_args__ = {"useexisting": True}
+    __table_args__ = (
+        db.Index("ix_oplog_admin_addtime", "admin_id", "addtime"),
+        db.Index("ix_oplog_addtime", "addtime"),
+        {"useexisting": True}
+    )
     id = db.Column(db.Integer, primary_key=True)  # 编号
     admin_id = db.Column(db.Integer, db.ForeignKey('admin.id'))  # 所属管理员
     ip = db.Column(db.String(100))  # 登录IP
@@ -181,8 +244,75 @@ class Oplog(db.Model):  # 操作日志
         return "<Oplog %r>" % self.id
 
 
+# 超过保留期限的登录、操作日志移入归档表，不带外键以便会员、管理员删除后仍可保留
+# 归档表使用自己的编号：MySQL重启后自增值按现有最大编号重置，清理后原日志编号可能重复
+userlog_archive = db.Table(
+    "userlog_archive",
+    db.Column("id", db.Integer, primary_key=True),  # 编号
+    db.Column("log_id", db.Integer, index=True),  # 原日志编号
+    db.Column("user_id", db.Integer),  # 所属会员
+    db.Column("ip", db.String(100)),  # 登录IP
+    db.Column("addtime", db.DateTime),  # 登录时间
+    db.Index("ix_userlog_archive_addtime", "addtime"),
+    useexisting=True
+)
+
+adminlog_archive = db.Table(
+    "adminlog_archive",
+    db.Column("id", db.Integer, primary_key=True),  # 编号
+    db.Column("log_id", db.Integer, index=True),  # 原日志编号
+    db.Column("admin_id", db.Integer),  # 所属管理员
+    db.Column("ip", db.String(100)),  # 登录IP
+    db.Column("addtime", db.DateTime),  # 登录时间
+    db.Index("ix_adminlog_archive_addtime", "addtime"),
+    useexisting=True
+)
+
+oplog_archive = db.Table(
+    "oplog_archive",
+    db.Column("id", db.Integer, primary_key=True),  # 编号
+    db.Column("log_id", db.Integer, index=True),  # 原日志编号
+    db.Column("admin_id", db.Integer),  # 所属管理员
+    db.Column("ip", db.String(100)),  # 登录IP
+    db.Column("reason", db.String(600)),  # 操作原因
+    db.Column("addtime", db.DateTime),  # 操作时间
+    db.Index("ix_oplog_archive_addtime", "addtime"),
+    useexisting=True
+)
+
+
+class LoginlogDaily(db.Model):  # 登录日志按天汇总
+    __tablename__ = "loginlog_daily"
+    __table_args__ = (
+        db.UniqueConstraint("kind", "subject_id", "ip", "day", name="uq_loginlog_daily"),
+        db.Index("ix_loginlog_daily_kind_day", "kind", "day", "id"),
+        {"useexisting": True}
+    )
+    id = db.Column(db.Integer, primary_key=True)  # 编号
+    kind = db.Column(db.String(20))  # 类型，user为会员，admin为管理员
+    subject_id = db.Column(db.Integer)  # 会员或管理员编号
+    ip = db.Column(db.String(100))  # 登录IP
+    day = db.Column(db.Date)  # 日期
+    num = db.Column(db.Integer, default=0)  # 登录次数
+
+    def __repr__(self):
+        return "<LoginlogDaily %r>" % self.id
+
+
+class PlaynumFlush(db.Model):  # 已写回数据库的播放量批次
+    __tablename__ = "playnum_flush"
+    __table_args__ = {"useexisting": True}
+    batch = db.Column(db.String(32), primary_key=True)  # 批次编号
+    addtime = db.Column(db.DateTime, index=True, default=datetime.now)  # 写回时间
+
+    def __repr__(self):
+        return "<PlaynumFlush %r>" % self.batch
+
+
 if __name__ == "__main__":
-    db.create_all()
+    from app.migrations import upgrade
+
+    upgrade()
     admin = Admin(name='admin', pwd=generate_password_hash('123456'), is_super=1)
     db.session.add(admin)
     db.session.commit()
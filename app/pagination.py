@@ -0,0 +1,148 @@
+import base64
+import datetime
+import json
+
+from flask import request, abort, url_for
+from sqlalchemy import and_, or_, false, Date, DateTime
+from sqlalchemy.sql import operators
+
+from app import app
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+DATE_FORMAT = "%Y-%m-%d"
+
+
+class KeysetPagination(object):
+    """ 游标分页结果，属性与Flask-SQLAlchemy的Pagination保持一致，供分页宏使用 """
+    keyset = True
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def split_order(order):
+    """ 把排序表达式拆成(列, 是否降序) """
+    modifier = getattr(order, "modifier", None)
+    if modifier is operators.desc_op:
+        return order.element, True
+    if modifier is operators.asc_op:
+        return order.element, False
+    return order, False
+
+
+def encode_cursor(item, keys):
+    """ 把一行记录的排序键编码成游标 """
+    values = []
+    for column, desc in keys:
+        value = getattr(item, column.key)
+        if isinstance(value, datetime.datetime):
+            value = value.strftime(DATETIME_FORMAT)
+        elif isinstance(value, datetime.date):
+            value = value.strftime(DATE_FORMAT)
+        values.append(value)
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, keys):
+    """ 解析游标，格式错误返回404 """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        if len(values) != len(keys):
+            raise ValueError(cursor)
+        for i, (column, desc) in enumerate(keys):
+            if values[i] is None:
+                continue
+            if isinstance(column.type, DateTime):
+                values[i] = datetime.datetime.strptime(values[i], DATETIME_FORMAT)
+            elif isinstance(column.type, Date):
+                values[i] = datetime.datetime.strptime(values[i], DATE_FORMAT).date()
+    except (TypeError, ValueError):
+        abort(404)
+    return values
+
+
+def less(column, value):
+    """ 排在value之前的值，与MySQL一致把NULL当作最小值 """
+    if value is None:
+        return false()
+    return or_(column < value, column.is_(None))
+
+
+def greater(column, value):
+    """ 排在value之后的值，NULL之后是所有非NULL值 """
+    if value is None:
+        return column.isnot(None)
+    return column > value
+
+
+def seek(keys, values, backward=False):
+    """ 生成 (k1, k2, ...) 位于游标之后的条件：k1 > v1 OR (k1 = v1 AND k2 > v2) ...，排序键可以为NULL """
+    clauses = []
+    for i, (column, desc) in enumerate(keys):
+        if desc != backward:
+            cond = less(column, values[i])
+        else:
+            cond = greater(column, values[i])
+        clauses.append(and_(*[keys[j][0] == values[j] for j in range(i)] + [cond]))
+    return or_(*clauses)
+
+
+def keyset_paginate(query, orders, per_page, after=None, before=None, count=False):
+    """ 游标分页：按排序键定位而不是OFFSET，orders最后一项应为主键以保证顺序唯一 """
+    keys = [split_order(v) for v in orders]
+    query = query.order_by(None)
+    total = query.count() if count else None
+    if before:
+        values = decode_cursor(before, keys)
+        reverse = [column.asc() if desc else column.desc() for column, desc in keys]
+        items = query.filter(seek(keys, values, backward=True)).order_by(*reverse).limit(per_page + 1).all()
+        has_prev = len(items) > per_page
+        items = items[:per_page][::-1]
+        has_next = True
+    else:
+        if after:
+            query = query.filter(seek(keys, decode_cursor(after, keys)))
+        items = query.order_by(*orders).limit(per_page + 1).all()
+        has_next = len(items) > per_page
+        items = items[:per_page]
+        has_prev = bool(after)
+    next_cursor = encode_cursor(items[-1], keys) if items and has_next else None
+    prev_cursor = encode_cursor(items[0], keys) if items and has_prev else None
+    return KeysetPagination(items, per_page, next_cursor, prev_cursor, total)
+
+
+def is_keyset():
+    """ 请求中带有after/before参数或全局开启时使用游标分页 """
+    return "after" in request.args or "before" in request.args or app.config["KEYSET_PAGINATION"]
+
+
+@app.template_global()
+def cursor_url(endpoint, **values):
+    """ 游标分页链接：保留当前的筛选、排序参数，替换分页参数，排序键不变游标才能解析 """
+    args = {k: v for k, v in request.args.items() if k not in ("page", "after", "before")}
+    args.update(values)
+    return url_for(endpoint, **args)
+
+
+def paginate(query, orders, page, per_page):
+    """ 列表分页：按请求选择游标分页或页码分页 """
+    if is_keyset():
+        return keyset_paginate(
+            query, orders, per_page,
+            after=request.args.get("after"),
+            before=request.args.get("before"),
+            count=app.config["KEYSET_PAGINATION_COUNT"]
+        )
+    return query.order_by(*orders).paginate(page=page, per_page=per_page)
@@ -0,0 +1,45 @@
+import atexit
+import threading
+import time
+
+from app import app, db
+
+
+def every(interval, func):
+    """ 启动后台线程，每隔interval秒在应用上下文中执行一次func """
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    func()
+                except Exception:
+                    app.logger.exception("periodic task %s failed", func.__name__)
+                finally:
+                    db.session.remove()
+
+    thread = threading.Thread(target=run, name=func.__name__)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def start():
+    """ 启动所有后台任务，只在服务器入口调用，导入app的脚本和测试不会启动线程 """
+    from app import counter, danmaku, metrics, logqueue, retention, storage, suggest
+    from app.admin import upload
+
+    tasks = (
+        ("PLAYNUM_FLUSH_INTERVAL", counter.flush),
+        ("DANMAKU_ARCHIVE_INTERVAL", danmaku.archive),
+        ("METRICS_FLUSH_INTERVAL", metrics.flush),
+        ("LOG_FLUSH_INTERVAL", logqueue.flush),
+        ("LOG_RETENTION_INTERVAL", retention.maintain),
+        ("SUGGEST_CHECK_INTERVAL", suggest.refresh),
+        ("UPLOAD_PURGE_INTERVAL", upload.purge),
+        ("STORAGE_GC_INTERVAL", storage.gc),
+    )
+    if app.config["LOG_FLUSH_INTERVAL"]:
+        atexit.register(logqueue.flush_at_exit)  # 后台批量写入日志时，退出前写入队列中剩余的日志
+    return [every(app.config[key], func) for key, func in tasks if app.config[key]]
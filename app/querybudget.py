@@ -0,0 +1,109 @@
+from functools import wraps
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+
+
+class QueryBudgetExceeded(Exception):
+    """ 请求执行的SQL语句数超过视图声明的预算 """
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """ 统计当前请求执行的SQL语句数 """
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+
+
+def query_budget(n):
+    """ 声明视图每个请求最多执行的SQL语句数 """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            g.query_budget = n
+            return f(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
+
+
+@app.before_request
+def reset_count():
+    g.query_count = 0
+    g.query_budget = None
+
+
+@app.after_request
+def check_budget(response):
+    budget = g.get("query_budget")
+    count = g.get("query_count", 0)
+    if budget is not None and count > budget:
+        message = "%s issued %d queries, budget %d" % (request.endpoint, count, budget)
+        if app.config["QUERY_BUDGET_STRICT"]:
+            raise QueryBudgetExceeded(message)
+        app.logger.warning(message)
+    return response
+
+
+def check(urls, admin_id=None, user_id=None):
+    """ 依次请求各地址，返回 [(地址, 语句数, 预算)] """
+    from app.models import Admin, User
+
+    client = app.test_client()
+    with client.session_transaction() as s:
+        if admin_id is not None:
+            s["admin"] = Admin.query.get(admin_id).name
+            s["admin_id"] = admin_id
+        if user_id is not None:
+            s["user"] = User.query.get(user_id).name
+            s["user_id"] = user_id
+    results = []
+    with client:
+        for url in urls:
+            client.get(url)
+            results.append((url, g.get("query_count", 0), g.get("query_budget")))
+    return results
+
+
+def over_budget(results):
+    return [v for v in results if v[2] is not None and v[1] > v[2]]
+
+
+if __name__ == "__main__":
+    import sys
+
+    from app.models import Admin, User, Movie
+
+    with app.app_context():
+        admin = Admin.query.first()
+        user = User.query.first()
+        movie = Movie.query.first()
+        urls = [
+            "/admin/movie/list/1/",
+            "/admin/comment/list/1/",
+            "/admin/moviecol/list/1/",
+            "/admin/oplog/list/1/",
+            "/admin/adminloginlog/list/1/",
+            "/admin/userloginlog/list/1/",
+            "/admin/admin/list/1/",
+            "/comments/1/",
+            "/moviecol/1/",
+            "/loginlog/1/",
+        ]
+        if movie is not None:
+            urls += ["/play/%d/1/" % movie.id, "/video/%d/1/" % movie.id]
+        results = check(
+            urls,
+            admin_id=admin.id if admin else None,
+            user_id=user.id if user else None
+        )
+    for url, count, budget in results:
+        print("%s %d/%s" % (url, count, budget))
+    problems = over_budget(results)
+    print("%d endpoint(s) over budget" % len(problems))
+    sys.exit(1 if problems else 0)
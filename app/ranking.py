@@ -0,0 +1,82 @@
+from app import db, rd
+from app.cache import make_key
+from app.models import Movie
+
+# 维护排行的字段
+FIELDS = ("playnum", "commentnum")
+
+
+def rank_key(field, tag_id=None):
+    """ 全站排行或标签排行的有序集合键 """
+    if tag_id:
+        return make_key("rank", field, "tag", tag_id)
+    return make_key("rank", field)
+
+
+def rebuild():
+    """ 从数据库重建全部排行 """
+    movies = db.session.query(Movie.id, Movie.tag_id, Movie.playnum, Movie.commentnum).all()
+    tag_ids = set(v.tag_id for v in movies)
+    pipe = rd.pipeline()
+    for field in FIELDS:
+        pipe.delete(rank_key(field), *[rank_key(field, v) for v in tag_ids])
+        for movie in movies:
+            score = getattr(movie, field) or 0
+            pipe.zadd(rank_key(field), score, movie.id)
+            pipe.zadd(rank_key(field, movie.tag_id), score, movie.id)
+    pipe.set(make_key("rank", "ready"), 1)
+    pipe.execute()
+
+
+def ensure():
+    """ 排行不存在时（首次启动或Redis被清空）重建 """
+    if not rd.exists(make_key("rank", "ready")):
+        rebuild()
+
+
+def incr(movie, field, amount=1):
+    """ 播放、评论发生时累加分数 """
+    pipe = rd.pipeline()
+    pipe.zincrby(rank_key(field), movie.id, amount)
+    pipe.zincrby(rank_key(field, movie.tag_id), movie.id, amount)
+    pipe.execute()
+
+
+def add(movie, old_tag_id=None):
+    """ 电影新增或修改后加入排行，已有分数保持不变 """
+    for field in FIELDS:
+        score = rd.zscore(rank_key(field), movie.id)
+        if score is None:
+            score = getattr(movie, field) or 0
+        pipe = rd.pipeline()
+        if old_tag_id is not None and old_tag_id != movie.tag_id:
+            pipe.zrem(rank_key(field, old_tag_id), movie.id)
+        pipe.zadd(rank_key(field), score, movie.id)
+        pipe.zadd(rank_key(field, movie.tag_id), score, movie.id)
+        pipe.execute()
+
+
+def remove(movie):
+    """ 电影删除后移出排行 """
+    pipe = rd.pipeline()
+    for field in FIELDS:
+        pipe.zrem(rank_key(field), movie.id)
+        pipe.zrem(rank_key(field, movie.tag_id), movie.id)
+    pipe.execute()
+
+
+def remove_tag(tag_id):
+    """ 标签删除后清除标签排行 """
+    rd.delete(*[rank_key(field, tag_id) for field in FIELDS])
+
+
+def page(field, tag_id, page, per_page, desc=True):
+    """ 读取一页排行，返回(电影编号列表, 总数) """
+    ensure()
+    key = rank_key(field, tag_id)
+    start = (page - 1) * per_page
+    if desc:
+        ids = rd.zrevrange(key, start, start + per_page - 1)
+    else:
+        ids = rd.zrange(key, start, start + per_page - 1)
+    return [int(v) for v in ids], rd.zcard(key)
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, literal, select
+
+from app import app, db, rd
+from app.cache import make_key
+from app.models import Userlog, Adminlog, Oplog, LoginlogDaily, userlog_archive, adminlog_archive, oplog_archive
+
+LOCK_KEY = make_key("logs", "retention", "lock")
+
+# (日志模型, 归档表)
+ARCHIVES = (
+    (Userlog, userlog_archive),
+    (Adminlog, adminlog_archive),
+    (Oplog, oplog_archive),
+)
+
+# (汇总类型, 日志模型, 所属会员或管理员字段)
+ROLLUPS = (
+    ("user", Userlog, Userlog.user_id),
+    ("admin", Adminlog, Adminlog.admin_id),
+)
+
+
+def rollup():
+    """ 把登录日志按 会员/管理员、IP、天 汇总，从已汇总的最后一天开始重新计算 """
+    for kind, model, subject in ROLLUPS:
+        start = db.session.query(func.max(LoginlogDaily.day)).filter(LoginlogDaily.kind == kind).scalar()
+        day = func.date(model.addtime)
+        query = select([
+            literal(kind), subject, model.ip, day, func.count(model.id)
+        ]).group_by(
+            subject, model.ip, day
+        )
+        if start is not None:
+            # 最后一天可能还在继续写入，先删掉再整天重算
+            LoginlogDaily.query.filter(
+                LoginlogDaily.kind == kind,
+                LoginlogDaily.day >= start
+            ).delete(synchronize_session=False)
+            query = query.where(model.addtime >= start)
+        db.session.execute(LoginlogDaily.__table__.insert().from_select(
+            ["kind", "subject_id", "ip", "day", "num"], query
+        ))
+        db.session.commit()
+
+
+def prune():
+    """ 把超过保留期限的日志按块移入归档表（或直接删除），返回处理的条数 """
+    cutoff = datetime.now() - timedelta(days=app.config["LOG_RETENTION_DAYS"])
+    chunk = app.config["LOG_PRUNE_CHUNK"]
+    total = 0
+    for model, archive in ARCHIVES:
+        while True:
+            ids = [v.id for v in db.session.query(model.id).filter(
+                model.addtime < cutoff
+            ).order_by(model.addtime).limit(chunk)]
+            if not ids:
+                break
+            if app.config["LOG_ARCHIVE"]:
+                # 归档表的编号自增，原编号写入log_id
+                columns = [v.name for v in archive.columns if v.name not in ("id", "log_id")]
+                db.session.execute(archive.insert().from_select(
+                    ["log_id"] + columns,
+                    select([model.id] + [model.__table__.c[v] for v in columns]).where(model.id.in_(ids))
+                ))
+            model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+            total += len(ids)
+            if len(ids) < chunk:
+                break
+    return total
+
+
+def maintain():
+    """ 先汇总再清理，由后台任务定期调用，多进程时只有一个进程执行 """
+    if not rd.set(LOCK_KEY, 1, nx=True, ex=3600):
+        return 0
+    try:
+        rollup()
+        return prune()
+    finally:
+        rd.delete(LOCK_KEY)
+
+
+if __name__ == "__main__":
+    print("pruned %d log(s)" % maintain())
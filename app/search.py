@@ -0,0 +1,191 @@
+import hashlib
+import re
+from collections import Counter
+
+from sqlalchemy import func, or_
+
+from app import app, db, rd
+from app.cache import make_key, get_version, bump_version, get_json, set_json
+from app.models import Movie
+
+TITLE_WEIGHT = 3  # 标题中出现的词权重高于简介
+INDEX_FORMAT = 2  # 分词方式变化时递增，启动后自动重建索引
+
+READY_KEY = make_key("search", "ready", INDEX_FORMAT)
+
+# 连续的中日韩文字，或连续的字母数字
+TOKEN_RE = re.compile(u"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af]+|[a-z0-9]+")
+
+
+def is_cjk(run):
+    return ord(run[0]) > 127
+
+
+def ngram_size(run):
+    """ 中日韩文字按两字切分，字母数字按三个字符切分 """
+    return 2 if is_cjk(run) else 3
+
+
+def tokenize(text):
+    """ 建索引用的分词：取长度不超过n的全部片段，单词的任意一部分都能搜到，返回 {词: 次数} """
+    terms = Counter()
+    for run in TOKEN_RE.findall((text or "").lower()):
+        for n in range(1, ngram_size(run) + 1):
+            terms.update(run[i:i + n] for i in range(len(run) - n + 1))
+    return terms
+
+
+def query_terms(text):
+    """ 查询用的分词：长于n时只取长度为n的片段，要求全部命中 """
+    terms = set()
+    for run in TOKEN_RE.findall((text or "").lower()):
+        n = ngram_size(run)
+        if len(run) > n:
+            terms.update(run[i:i + n] for i in range(len(run) - n + 1))
+        else:
+            terms.add(run)
+    return sorted(terms)
+
+
+def term_key(term):
+    """ 倒排表：有序集合，成员为电影编号，分数为词权重 """
+    return make_key("search", "term", term)
+
+
+def doc_key(movie_id):
+    """ 电影已索引的词，更新和删除时用来清理倒排表 """
+    return make_key("search", "doc", movie_id)
+
+
+def movie_terms(movie):
+    """ 电影标题和简介的词及权重 """
+    terms = Counter()
+    for term, n in tokenize(movie.title).items():
+        terms[term] = n * TITLE_WEIGHT
+    terms.update(tokenize(movie.info))
+    return terms
+
+
+def write_terms(pipe, movie_id, terms, old=()):
+    for term in old:
+        if term not in terms:
+            pipe.zrem(term_key(term), movie_id)
+    for term, score in terms.items():
+        pipe.zadd(term_key(term), score, movie_id)
+    pipe.delete(doc_key(movie_id))
+    if terms:
+        pipe.sadd(doc_key(movie_id), *terms)
+
+
+def index_movie(movie):
+    """ 新增或更新一部电影的索引 """
+    old = [v.decode("utf-8") for v in rd.smembers(doc_key(movie.id))]
+    pipe = rd.pipeline()
+    write_terms(pipe, movie.id, movie_terms(movie), old)
+    pipe.execute()
+    bump_version("search")
+
+
+def remove_movie(movie_id):
+    """ 删除一部电影的索引 """
+    old = [v.decode("utf-8") for v in rd.smembers(doc_key(movie_id))]
+    pipe = rd.pipeline()
+    write_terms(pipe, movie_id, {}, old)
+    pipe.execute()
+    bump_version("search")
+
+
+def rebuild():
+    """ 清空后从数据库重建全部索引 """
+    keys = list(rd.scan_iter(match=make_key("search", "*"), count=1000))
+    for i in range(0, len(keys), 1000):
+        rd.delete(*keys[i:i + 1000])
+    pipe = rd.pipeline(transaction=False)
+    for i, movie in enumerate(db.session.query(Movie.id, Movie.title, Movie.info).yield_per(500)):
+        write_terms(pipe, movie.id, movie_terms(movie))
+        if i % 500 == 499:
+            pipe.execute()
+    pipe.set(READY_KEY, 1)
+    pipe.execute()
+    bump_version("search")
+
+
+def ensure():
+    """ 索引不存在时（首次启动或Redis被清空）重建 """
+    if not rd.exists(READY_KEY):
+        rebuild()
+
+
+def search(text, page, per_page):
+    """ 按相关度排序的一页结果，返回(电影编号列表, 命中总数) """
+    terms = query_terms(text)
+    if not terms:
+        return [], 0
+    ensure()
+    if len(terms) == 1:
+        key = term_key(terms[0])
+    else:
+        # 多个词取交集，分数相加；同样的查询在索引变化前复用交集结果
+        digest = hashlib.md5("|".join(terms).encode("utf-8")).hexdigest()
+        key = make_key("search", "result", get_version("search"), digest)
+        if not rd.exists(key):
+            pipe = rd.pipeline()
+            pipe.zinterstore(key, [term_key(v) for v in terms])
+            pipe.expire(key, app.config["CACHE_TIMEOUT"])
+            pipe.execute()
+    start = (page - 1) * per_page
+    pipe = rd.pipeline()
+    pipe.zrevrange(key, start, start + per_page - 1)
+    pipe.zcard(key)
+    ids, total = pipe.execute()
+    return [int(v) for v in ids], total
+
+
+def normalize(text):
+    """ 小写并合并空白，作为结果缓存的键 """
+    return " ".join((text or "").lower().split())
+
+
+def sql_search(text, page, per_page):
+    """ 数据库LIKE查询，用窗口函数在同一条语句中取总数，返回(电影列表, 命中总数) """
+    pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    condition = or_(Movie.title.ilike(pattern, escape="\\"), Movie.info.ilike(pattern, escape="\\"))
+    rows = db.session.query(
+        Movie, func.count().over().label("total")
+    ).filter(
+        condition
+    ).order_by(
+        Movie.addtime.desc(), Movie.id.desc()
+    ).limit(per_page).offset((page - 1) * per_page).all()
+    if rows:
+        return [v.Movie for v in rows], rows[0].total
+    if page == 1:
+        return [], 0
+    # 超出最后一页时没有行可带回总数
+    return [], Movie.query.filter(condition).count()
+
+
+def results(text, page, per_page):
+    """ 一页搜索结果，按规范化的关键字和页码缓存，返回(电影字典列表, 命中总数) """
+    text = normalize(text)
+    digest = hashlib.md5(text.encode("utf-8")).hexdigest()
+    key = make_key("search", "page", app.config["SEARCH_BACKEND"], get_version("search"), digest, page, per_page)
+    data = get_json(key)
+    if data is None:
+        if app.config["SEARCH_BACKEND"] == "sql":
+            movies, total = sql_search(text, page, per_page)
+        else:
+            ids, total = search(text, page, per_page)
+            movies = Movie.query.filter(Movie.id.in_(ids)).all() if ids else []
+            movies.sort(key=lambda v: ids.index(v.id))
+        data = dict(
+            total=total,
+            items=[dict(id=v.id, title=v.title, logo=v.logo, info=v.info) for v in movies]
+        )
+        set_json(key, data, app.config["SEARCH_CACHE_TIMEOUT"])
+    return data["items"], data["total"]
+
+
+if __name__ == "__main__":
+    rebuild()
+    print("search index rebuilt")
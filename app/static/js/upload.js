@@ -0,0 +1,170 @@
+/* 视频分块上传：选择文件后按块PUT到服务器，断线或刷新后从服务器记录的偏移续传 */
+(function () {
+    var CHUNK_SIZE = 5 * 1024 * 1024;
+    var TABLE = (function () {
+        var table = [];
+        for (var n = 0; n < 256; n++) {
+            var c = n;
+            for (var k = 0; k < 8; k++) {
+                c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+            }
+            table[n] = c >>> 0;
+        }
+        return table;
+    })();
+
+    // 增量CRC32，与服务器端zlib.crc32一致
+    function crc32(bytes, crc) {
+        crc = (crc ^ 0xFFFFFFFF) >>> 0;
+        for (var i = 0; i < bytes.length; i++) {
+            crc = TABLE[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+        }
+        return (crc ^ 0xFFFFFFFF) >>> 0;
+    }
+
+    function request(method, url, body, headers) {
+        return new Promise(function (resolve, reject) {
+            var xhr = new XMLHttpRequest();
+            xhr.open(method, url);
+            for (var name in headers || {}) {
+                xhr.setRequestHeader(name, headers[name]);
+            }
+            xhr.onload = function () {
+                var data = {};
+                try {
+                    data = JSON.parse(xhr.responseText);
+                } catch (e) {
+                }
+                data.status = xhr.status;
+                (xhr.status < 300 ? resolve : reject)(data);
+            };
+            xhr.onerror = function () {
+                reject({status: 0, error: "网络错误"});
+            };
+            xhr.send(body);
+        });
+    }
+
+    function postJSON(url, data) {
+        return request("POST", url, JSON.stringify(data), {"Content-Type": "application/json"});
+    }
+
+    function readBytes(blob) {
+        return new Promise(function (resolve) {
+            var reader = new FileReader();
+            reader.onload = function () {
+                resolve(new Uint8Array(reader.result));
+            };
+            reader.readAsArrayBuffer(blob);
+        });
+    }
+
+    // 从头计算已上传部分的CRC32，续传时与服务器记录的值比较
+    function crcUntil(file, offset) {
+        var crc = 0, position = 0;
+
+        function next() {
+            if (position >= offset) {
+                return Promise.resolve(crc);
+            }
+            var stop = Math.min(position + CHUNK_SIZE, offset);
+            return readBytes(file.slice(position, stop)).then(function (bytes) {
+                crc = crc32(bytes, crc);
+                position = stop;
+                return next();
+            });
+        }
+
+        return next();
+    }
+
+    window.chunkedUpload = function (options) {
+        var input = document.getElementById(options.input);
+        var hidden = document.getElementById(options.hidden);
+        var progress = document.getElementById(options.progress);
+        var base = options.url;
+
+        function show(text) {
+            progress.innerHTML = text;
+        }
+
+        function start(file) {
+            var storeKey = "upload:" + [file.name, file.size, file.lastModified].join(":");
+            var saved = window.localStorage.getItem(storeKey);
+            var session = saved ?
+                request("GET", base + saved + "/").catch(function () {
+                    return postJSON(base, {filename: file.name, size: file.size});
+                }) :
+                postJSON(base, {filename: file.name, size: file.size});
+            var retries = 0;
+
+            return session.then(function (info) {
+                window.localStorage.setItem(storeKey, info.id);
+                return crcUntil(file, info.offset).then(function (crc) {
+                    if (crc !== info.crc) {
+                        // 本地文件与已上传部分不一致，重新开始
+                        window.localStorage.removeItem(storeKey);
+                        return postJSON(base, {filename: file.name, size: file.size}).then(function (info) {
+                            window.localStorage.setItem(storeKey, info.id);
+                            return send(info, 0);
+                        });
+                    }
+                    return send(info, crc);
+                });
+            });
+
+            function send(info, crc) {
+                var url = base + info.id + "/";
+                if (info.offset >= file.size) {
+                    return postJSON(url + "finish/", {crc: crc}).then(function (info) {
+                        window.localStorage.removeItem(storeKey);
+                        hidden.value = info.id;
+                        input.value = "";
+                        show("上传完成");
+                        return info;
+                    });
+                }
+                show("已上传 " + Math.floor(info.offset * 100 / Math.max(file.size, 1)) + "%");
+                var stop = Math.min(info.offset + CHUNK_SIZE, file.size);
+                return readBytes(file.slice(info.offset, stop)).then(function (bytes) {
+                    var partCrc = crc32(bytes, 0);
+                    return request("PUT", url + "?offset=" + info.offset, bytes, {
+                        "Content-Type": "application/octet-stream",
+                        "X-Chunk-Crc32": String(partCrc)
+                    }).then(function (next) {
+                        retries = 0;
+                        return send(next, crc32(bytes, crc));
+                    }, function (error) {
+                        // 网络错误或偏移不一致时从服务器记录的偏移重试
+                        if (retries++ >= 5 || error.status === 404) {
+                            throw error;
+                        }
+                        return new Promise(function (resolve) {
+                            setTimeout(resolve, 1000 * retries);
+                        }).then(function () {
+                            return request("GET", url);
+                        }).then(function (info) {
+                            return crcUntil(file, info.offset).then(function (crc) {
+                                return send(info, crc);
+                            });
+                        });
+                    });
+                });
+            }
+        }
+
+        input.addEventListener("change", function () {
+            var file = input.files[0];
+            hidden.value = "";
+            if (!file || !window.Promise || !window.FileReader) {
+                return;  // 不支持时按普通表单上传
+            }
+            input.disabled = true;
+            start(file).catch(function (error) {
+                show("上传失败：" + (error.error || error.status));
+            }).then(function () {
+                input.disabled = false;
+            });
+        });
+    };
+})();
@@ -0,0 +1,201 @@
+import glob
+import hashlib
+import os
+import re
+import shutil
+import sys
+import time
+import uuid
+
+from werkzeug.utils import secure_filename
+
+from app import app, db, rd
+from app.cache import make_key, bump_version
+from app.models import Movie, Preview, User
+
+GC_LOCK_KEY = make_key("storage", "gc", "lock")
+
+# 按内容命名的文件：sha256前两位/三四位/sha256.扩展名
+NAME_RE = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(\.[a-z0-9]+)?$")
+SHARD_RE = re.compile(r"^[0-9a-f]{2}$")
+
+# (保存目录的配置项, 引用文件的字段)，引用数由这些字段统计
+REFERENCES = (
+    ("UP_DIR", Movie.url),
+    ("UP_DIR", Movie.logo),
+    ("UP_DIR", Preview.logo),
+    ("FC_DIR", User.face),
+)
+
+
+def is_stored(name):
+    """ 是否为按内容命名的文件 """
+    return bool(name and NAME_RE.match(name))
+
+
+def stem(name):
+    """ 去掉扩展名和尺寸后缀的部分，原图和它的衍生图相同 """
+    return os.path.splitext(name)[0].split("_")[0]
+
+
+def variant(name, size, ext):
+    """ 衍生图的文件名：ab/cd/<sha256>_<尺寸>.<扩展名> """
+    return "%s_%s.%s" % (stem(name), size, ext)
+
+
+def make_name(digest, filename):
+    ext = os.path.splitext(secure_filename(filename or ""))[1].lower()
+    return "%s/%s/%s%s" % (digest[:2], digest[2:4], digest, ext)
+
+
+def temp_path(directory):
+    """ 与目标文件同一目录下的临时文件，写完后原子改名 """
+    return os.path.join(directory, ".tmp-%s" % uuid.uuid4().hex)
+
+
+def commit(directory, tmp, name):
+    """ 把临时文件改名为name；内容相同的文件已存在时删掉临时文件，更新已有文件的修改时间 """
+    path = os.path.join(directory, name)
+    if os.path.exists(path):
+        os.remove(tmp)
+        os.utime(path, None)  # 刚复用的文件在宽限期内不会被回收
+    else:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.rename(tmp, path)
+    return name
+
+
+def save(file, key="UP_DIR"):
+    """ 保存上传的文件，边写边计算sha256，返回相对于目录的文件名 """
+    directory = app.config[key]
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp = temp_path(directory)
+    sha = hashlib.sha256()
+    buffer_size = app.config["MEDIA_BUFFER_SIZE"]
+    with open(tmp, "wb") as f:
+        while True:
+            data = file.stream.read(buffer_size)
+            if not data:
+                break
+            sha.update(data)
+            f.write(data)
+    return commit(directory, tmp, make_name(sha.hexdigest(), file.filename))
+
+
+def store(path, filename, key="UP_DIR"):
+    """ 把已在磁盘上的文件（分块上传的临时文件、旧文件）移入存储，返回文件名 """
+    directory = app.config[key]
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    sha = hashlib.sha256()
+    buffer_size = app.config["MEDIA_BUFFER_SIZE"]
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(buffer_size)
+            if not data:
+                break
+            sha.update(data)
+    tmp = temp_path(directory)
+    shutil.move(path, tmp)  # 可能跨文件系统，先移到目标目录再改名
+    return commit(directory, tmp, make_name(sha.hexdigest(), filename))
+
+
+def refcount(key, name):
+    """ 引用该文件的记录数 """
+    return sum(
+        db.session.query(column).filter(column == name).count()
+        for directory, column in REFERENCES if directory == key
+    )
+
+
+def release(key, *names):
+    """ 记录不再引用文件后调用（需在提交之后），没有引用的文件直接删除 """
+    # 只跳过刚被其他请求保存或复用、记录还没提交的文件；不用回收的宽限期，否则刚上传又被替换的文件要等下次回收
+    grace = time.time() - app.config["STORAGE_RELEASE_GRACE"]
+    for name in names:
+        if not is_stored(name) or refcount(key, name):
+            continue
+        path = os.path.join(app.config[key], name)
+        if os.path.exists(path) and os.path.getmtime(path) < grace:
+            os.remove(path)
+            for derived in glob.glob(os.path.join(app.config[key], stem(name) + "_*")):
+                os.remove(derived)
+
+
+def referenced(key):
+    """ 目录中被引用的全部文件名 """
+    names = set()
+    for directory, column in REFERENCES:
+        if directory == key:
+            names.update(v[0] for v in db.session.query(column).filter(column.isnot(None)).yield_per(1000))
+    return names
+
+
+def walk(directory):
+    """ 遍历两级分片目录，返回(文件名, 路径)；不进入旧的平铺文件和其他子目录 """
+    for first in sorted(os.listdir(directory)):
+        if not SHARD_RE.match(first) or not os.path.isdir(os.path.join(directory, first)):
+            continue
+        for second in sorted(os.listdir(os.path.join(directory, first))):
+            if not SHARD_RE.match(second):
+                continue
+            for filename in os.listdir(os.path.join(directory, first, second)):
+                yield "%s/%s/%s" % (first, second, filename), os.path.join(directory, first, second, filename)
+
+
+def gc():
+    """ 删除没有记录引用的文件及其衍生图、残留的临时文件，返回删除的个数 """
+    if not rd.set(GC_LOCK_KEY, 1, nx=True, ex=3600):
+        return 0
+    try:
+        grace = time.time() - app.config["STORAGE_GC_GRACE"]
+        removed = 0
+        for key in ("UP_DIR", "FC_DIR"):
+            directory = app.config[key]
+            if not os.path.exists(directory):
+                continue
+            stems = set(stem(v) for v in referenced(key))
+            for filename in os.listdir(directory):
+                path = os.path.join(directory, filename)
+                if filename.startswith(".tmp-") and os.path.getmtime(path) < grace:
+                    os.remove(path)
+                    removed += 1
+            for name, path in walk(directory):
+                if stem(name) not in stems and os.path.getmtime(path) < grace:
+                    os.remove(path)
+                    removed += 1
+        return removed
+    finally:
+        rd.delete(GC_LOCK_KEY)
+
+
+def migrate():
+    """ 把按时间和随机串命名的旧文件移入存储并更新记录，返回迁移的文件数 """
+    moved = 0
+    for key, column in REFERENCES:
+        model = column.class_
+        rows = db.session.query(model.id, column).filter(column.isnot(None), column != "").all()
+        for id, name in rows:
+            if is_stored(name):
+                continue
+            path = os.path.join(app.config[key], name)
+            if not os.path.isfile(path):
+                app.logger.warning("storage migrate: %s %s missing", model.__tablename__, name)
+                continue
+            model.query.filter(model.id == id).update({column: store(path, name, key)}, synchronize_session=False)
+            db.session.commit()
+            moved += 1
+    if moved:
+        bump_version("catalog")
+        bump_version("search")
+    return moved
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "gc"
+    if command == "migrate":
+        print("migrated %d file(s)" % migrate())
+    else:
+        print("removed %d file(s)" % gc())
@@ -0,0 +1,88 @@
+import bisect
+import heapq
+import threading
+import time
+
+from app import app, db
+from app.cache import get_version
+from app.models import Movie
+
+SCAN_LIMIT = 200  # 匹配数超过这个值的前缀预先算好结果，其余前缀直接扫描匹配范围
+
+lock = threading.Lock()
+index = None  # 当前的前缀索引
+
+
+class PrefixIndex(object):
+    """ 按小写标题排序的数组，用二分查找定位前缀范围，按播放量取前几部；匹配多的前缀预先算好结果 """
+
+    def __init__(self, version, movies, size):
+        self.version = version
+        self.built = time.time()
+        self.size = size
+        entries = sorted((v.title.lower(), -(v.playnum or 0), v.id, v.title) for v in movies if v.title)
+        self.keys = [v[0] for v in entries]
+        self.entries = entries
+        self.top = {}
+        stack = [(u"", 0, len(entries))]
+        while stack:
+            prefix, lo, hi = stack.pop()
+            if prefix:
+                self.top[prefix] = heapq.nsmallest(size, (v[1:] for v in entries[lo:hi]))
+            # 按下一个字符拆分匹配范围，只有范围仍然较大的前缀才继续拆分
+            n = len(prefix)
+            i = lo
+            while i < hi:
+                if len(self.keys[i]) <= n:
+                    i += 1
+                    continue
+                child = self.keys[i][:n + 1]
+                j = self.end(child, i, hi)
+                if j - i > SCAN_LIMIT:
+                    stack.append((child, i, j))
+                i = j
+
+    def end(self, prefix, lo=0, hi=None):
+        """ 以prefix开头的范围的结束位置 """
+        return bisect.bisect_left(self.keys, prefix + u"\U0010ffff", lo, len(self.keys) if hi is None else hi)
+
+    def complete(self, prefix):
+        """ 以prefix开头、播放量最高的标题，返回 [(编号, 标题)] """
+        prefix = prefix.lower()
+        if prefix in self.top:
+            items = self.top[prefix]
+        else:
+            lo = bisect.bisect_left(self.keys, prefix)
+            items = heapq.nsmallest(self.size, (v[1:] for v in self.entries[lo:self.end(prefix, lo)]))
+        return [(id, title) for playnum, id, title in items]
+
+
+def build(version):
+    movies = db.session.query(Movie.id, Movie.title, Movie.playnum).all()
+    return PrefixIndex(version, movies, app.config["SUGGEST_SIZE"])
+
+
+def refresh():
+    """ 电影增删改或超过刷新间隔后重建索引，由后台任务定期调用，请求中只读取已建好的索引 """
+    global index
+    version = get_version("catalog")
+    if index is None or index.version != version or time.time() - index.built > app.config["SUGGEST_REFRESH"]:
+        index = build(version)  # 建好后整体替换，请求读到的总是完整的索引
+    return index
+
+
+def current():
+    """ 当前索引，进程中还没有索引时先建一次（没有启动后台任务的进程之后不再重建） """
+    if index is None:
+        with lock:
+            if index is None:
+                return refresh()
+    return index
+
+
+def suggest(prefix):
+    """ 标题补全 """
+    prefix = prefix.strip()
+    if not prefix:
+        return []
+    return current().complete(prefix)
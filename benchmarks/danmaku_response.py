@@ -0,0 +1,55 @@
+""" 对比 /tm/ 旧的反序列化再序列化实现与直接拼接存储JSON的实现
+
+    python benchmarks/danmaku_response.py [弹幕条数]
+"""
+import datetime
+import json
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.danmaku import render, stream
+
+
+def make_msgs(count):
+    """ 生成与 home.views.tm 存储格式相同的弹幕 """
+    msgs = []
+    for i in range(count):
+        msgs.append(json.dumps({
+            "__v": 0,
+            "author": "user%d" % i,
+            "time": i * 0.5,
+            "text": "弹幕内容%d" % i,
+            "color": "#ffffff",
+            "type": "right",
+            "ip": "127.0.0.1",
+            "_id": datetime.datetime.now().strftime("%Y%m%d%H%M%S") + uuid.uuid4().hex,
+            "player": ["1"]
+        }).encode("utf-8"))
+    return msgs
+
+
+def legacy(msgs):
+    """ 原 home.views.tm 的GET实现 """
+    res = {
+        "code": 1,
+        "danmaku": [json.loads(v) for v in msgs]
+    }
+    return json.dumps(res)
+
+
+def main(count):
+    msgs = make_msgs(count)
+    assert json.loads(legacy(msgs)) == json.loads(render(msgs).decode("utf-8"))
+    assert render(msgs) == b"".join(stream(msgs))
+    number = 200
+    for name, f in [("legacy", legacy), ("render", render), ("stream", lambda v: b"".join(stream(v)))]:
+        seconds = min(timeit.repeat(lambda: f(msgs), number=number, repeat=3))
+        print("%-8s %8.3f ms/request" % (name, seconds / number * 1000))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
@@ -1,4 +1,21 @@
-from app import app
+import os
+
+# ASYNC_MODE=gevent 时使用协程服务器，弹幕推送的长连接只占用协程
+ASYNC_MODE = os.environ.get("ASYNC_MODE")
+if ASYNC_MODE == "gevent":
+    from gevent import monkey
+
+    monkey.patch_all()
+
+from app import app, periodic
+
+# 后台任务只在服务器进程中启动（python manager.py 或 gunicorn manager:app）
+periodic.start()
 
 if __name__ == "__main__":
-    app.run()
+    if ASYNC_MODE == "gevent":
+        from gevent.pywsgi import WSGIServer
+
+        WSGIServer(("127.0.0.1", 5000), app).serve_forever()
+    else:
+        app.run(threaded=True)
@@ -0,0 +1,72 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+import redis
+from werkzeug.security import generate_password_hash
+
+from app import app, db, rd
+from app.models import Tag, Movie, User, Admin, Comment, Moviecol, Userlog, Adminlog, Oplog
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# 各测试模块共用的临时SQLite库和Redis，测试模块中导入setUpModule、tearDownModule使用
+db_file = None
+
+
+def setUpModule():
+    global db_file
+    fd, db_file = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_file
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.config["LOG_FLUSH_INTERVAL"] = 0  # 日志同步写入
+    if fakeredis is not None:
+        rd._redis_client = fakeredis.FakeStrictRedis()
+    else:
+        app.config["REDIS_URL"] = os.environ.get("TEST_REDIS_URL", "redis://127.0.0.1:6379/15")
+        rd.init_app(app)
+        try:
+            rd.ping()
+        except redis.ConnectionError:
+            raise unittest.SkipTest("Redis is not available")
+    rd.flushdb()
+    with app.app_context():
+        db.create_all()
+        seed()
+
+
+def tearDownModule():
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+    os.remove(db_file)
+
+
+def seed():
+    tag = Tag(name="tag")
+    db.session.add(tag)
+    db.session.commit()
+    user = User(name="user", pwd=generate_password_hash("pwd"), email="user@example.com", phone="13800000000",
+                uuid="user")
+    admin = Admin(name="admin", pwd=generate_password_hash("pwd"), is_super=0)
+    db.session.add_all([user, admin])
+    db.session.commit()
+    for i in range(12):
+        db.session.add(Movie(
+            title="movie%d" % i, url="movie%d.mp4" % i, info="info", logo="movie%d.png" % i, star=3,
+            playnum=0, commentnum=0, tag_id=tag.id, area="area", release_time=datetime.date.today(), length="90"
+        ))
+    db.session.commit()
+    for i in range(12):
+        db.session.add(Comment(content="comment%d" % i, movie_id=1, user_id=user.id))
+        db.session.add(Moviecol(movie_id=i + 1, user_id=user.id))
+        db.session.add(Userlog(user_id=user.id, ip="127.0.0.1"))
+        db.session.add(Adminlog(admin_id=admin.id, ip="127.0.0.1"))
+        db.session.add(Oplog(admin_id=admin.id, ip="127.0.0.1", reason="reason%d" % i))
+    db.session.commit()
@@ -0,0 +1,46 @@
+import re
+import unittest
+
+from app import app
+from tests import setUpModule, tearDownModule  # noqa: F401
+
+
+def link(html, text):
+    """ 分页导航中某个链接的地址 """
+    match = re.search(r'<a href="([^"]*)">%s</a>' % text, html)
+    return match.group(1).replace("&amp;", "&") if match else None
+
+
+class KeysetLinkTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["KEYSET_PAGINATION"] = True
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config["KEYSET_PAGINATION"] = False
+
+    def test_next_link_keeps_filters(self):
+        for query in ("pm=1", "time=1", "tid=1&star=3&cm=2"):
+            response = self.client.get("/?" + query)
+            self.assertEqual(response.status_code, 200)
+            url = link(response.get_data(as_text=True), "下一页")
+            self.assertIsNotNone(url, query)
+            for param in query.split("&"):
+                self.assertIn(param, url)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            url = link(response.get_data(as_text=True), "上一页")
+            self.assertEqual(self.client.get(url).status_code, 200, url)
+
+    def test_first_link_stays_in_keyset_mode(self):
+        app.config["KEYSET_PAGINATION"] = False
+        response = self.client.get("/?pm=1&after=")
+        url = link(response.get_data(as_text=True), "首页")
+        self.assertIn("after=", url)
+        self.assertIn("pm=1", url)
+        self.assertIsNotNone(link(self.client.get(url).get_data(as_text=True), "下一页"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import logging
+import unittest
+
+from flask import g
+
+from app import app
+from app.models import Movie
+from app.querybudget import QueryBudgetExceeded, check, check_budget, over_budget
+from tests import setUpModule, tearDownModule  # noqa: F401
+
+URLS = [
+    "/admin/movie/list/1/",
+    "/admin/comment/list/1/",
+    "/admin/moviecol/list/1/",
+    "/admin/oplog/list/1/",
+    "/admin/adminloginlog/list/1/",
+    "/admin/userloginlog/list/1/",
+    "/admin/admin/list/1/",
+    "/comments/1/",
+    "/moviecol/1/",
+    "/loginlog/1/",
+    "/play/1/1/",
+    "/video/1/1/",
+]
+
+
+class QueryBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        app.config["QUERY_BUDGET_STRICT"] = True
+
+    def test_list_views_stay_within_budget(self):
+        with app.app_context():
+            results = check(URLS, admin_id=1, user_id=1)
+        for url, count, budget in results:
+            self.assertIsNotNone(budget, url)
+        self.assertEqual(over_budget(results), [])
+
+    def test_comment_post_stays_within_budget(self):
+        client = app.test_client()
+        with client.session_transaction() as s:
+            s["user"] = "user"
+            s["user_id"] = 1
+        for url in ("/play/2/1/", "/video/2/1/"):
+            with client:
+                response = client.post(url, data={"content": "new comment"})
+                self.assertEqual(response.status_code, 302)
+                self.assertLessEqual(g.query_count, g.query_budget)
+        with app.app_context():
+            self.assertEqual(Movie.query.get(2).commentnum, 2)
+
+    def test_strict_mode_raises_when_over_budget(self):
+        with app.test_request_context("/"):
+            g.query_budget = 1
+            g.query_count = 2
+            with self.assertRaises(QueryBudgetExceeded):
+                check_budget(app.response_class())
+
+    def test_warns_when_not_strict(self):
+        app.config["QUERY_BUDGET_STRICT"] = False
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        app.logger.addHandler(handler)
+        try:
+            with app.test_request_context("/"):
+                g.query_budget = 1
+                g.query_count = 2
+                check_budget(app.response_class())
+        finally:
+            app.logger.removeHandler(handler)
+        self.assertEqual(len(records), 1)
+        self.assertIn("budget 1", records[0].getMessage())
+
+
+if __name__ == "__main__":
+    unittest.main()